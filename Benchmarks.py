@@ -0,0 +1,239 @@
+# === [ Credential Manager Benchmarks ] === #
+# Benchmarks for the hot paths of CredentialManager, run against an in-memory SQLite database filled with synthetic users.
+# "python Benchmarks.py" runs the data path suite, "cache" benchmarks cache lookups, "hashing" compares password hasher settings
+# and "substitution" measures %variable% expansion as more variables are defined.
+# Use --output to save the results as JSON and --baseline to compare them against an earlier run; regressions set a non-zero exit code.
+
+import CredentialManager as cm
+import JUtils2 as jutils
+import contextlib
+import argparse
+import platform
+import sqlite3
+import random
+import json
+import time
+import sys
+import os
+import io
+
+def timePerCall(function, keys):
+    """Returns the average time in nanoseconds it takes to call 'function' with each key."""
+    start = time.perf_counter_ns()
+    for key in keys:
+        function(key)
+    return (time.perf_counter_ns() - start) / len(keys)
+
+def bestOf(repeat, measure):
+    """Calls 'measure' 'repeat' times and returns the lowest result, which is the least disturbed by whatever else the machine was doing."""
+    return min(measure() for x in range(0, repeat))
+
+def fillCache(size):
+    """Fills the user cache with 'size' synthetic users without touching the database."""
+    cm.CredentialManager.setCache(cm.UserCache(maxEntries = 0, ttl = 0))
+    for x in range(0, size):
+        cm.CredentialManager.resultsToUser((f"id{x}", f"user{x}", f"nick{x}", "member", 0, False))
+
+def benchmarkCacheHits(sizes = (10000, 100000, 1000000), lookups = 100000):
+    """Measures cache hit latency for getUserById and getUserByName at each cache size."""
+    print("{:^12}|{:^20}|{:^20}".format("Cached", "getUserById (ns)", "getUserByName (ns)"))
+    print("-" * 54)
+    for size in sizes:
+        fillCache(size)
+        sample = [random.randrange(0, size) for x in range(0, lookups)]
+        byId = timePerCall(cm.CredentialManager.getUserById, [f"id{x}" for x in sample])
+        byName = timePerCall(cm.CredentialManager.getUserByName, [f"user{x}" for x in sample])
+        print(" {: <11}| {: <19.1f}| {: <19.1f}".format(size, byId, byName))
+    cm.CredentialManager.clearCache()
+
+# Hasher settings compared by benchmarkHashing, from cheapest to most expensive.
+hashSettings = [
+    {"algorithm": "pbkdf2-sha256", "iterations": 100000},
+    {"algorithm": "pbkdf2-sha256", "iterations": 300000},
+    {"algorithm": "pbkdf2-sha256", "iterations": 600000},
+    {"algorithm": "scrypt", "n": 16384, "r": 8, "p": 1},
+    {"algorithm": "scrypt", "n": 65536, "r": 8, "p": 1}
+]
+
+def benchmarkHashing(settings = None, count = 20, bulkCount = 200):
+    """Measures single hash latency and bulk hashMany throughput for each hasher setting, to size the work factor to a latency budget."""
+    settings = hashSettings if settings == None else settings
+    print("{:^34}|{:^16}|{:^16}|{:^18}".format("Setting", "Latency (ms)", "Hashes/sec", "hashMany/sec"))
+    print("-" * 87)
+    for setting in settings:
+        hasher = jutils.PasswordHasher(**setting)
+        start = time.perf_counter()
+        for x in range(0, count):
+            hasher.hash(f"password{x}")
+        single = (time.perf_counter() - start) / count
+        hasher.hashMany(["warmup"] * bulkCount)
+        start = time.perf_counter()
+        hasher.hashMany([f"password{x}" for x in range(0, bulkCount)])
+        bulk = bulkCount / (time.perf_counter() - start)
+        hasher.close()
+        print(" {: <33}| {: <15.2f}| {: <15.1f}| {: <17.1f}".format(f"{hasher.algorithm} ({hasher.getParameters()})", single * 1000, 1 / single, bulk))
+
+def benchmarkSubstitution(counts = (10, 1000, 100000), arguments = 10000):
+    """Compares Utilities.replaceAll with Utilities.substitute when expanding script arguments with 'counts' variables defined."""
+    lines = ["%user% was given the role %role%", "no variables here", "%counter%", "progress: 50% of %total%", "%missing% stays as is"]
+    print("{:^12}|{:^20}|{:^20}|{:^10}".format("Variables", "replaceAll (ns)", "substitute (ns)", "Speedup"))
+    print("-" * 65)
+    for count in counts:
+        values = {f"var{x}": x for x in range(0, count)}
+        values.update({"user": "user1", "role": "admin", "counter": 5, "total": 100})
+        sample = [lines[x % len(lines)] for x in range(0, arguments)]
+        # replaceAll gets slower with every variable, so it expands fewer arguments to keep the run short.
+        old = bestOf(3, lambda: timePerCall(lambda x: jutils.Utilities.replaceAll(x, values), sample[:max(10, arguments * 10 // count)]))
+        new = bestOf(3, lambda: timePerCall(lambda x: jutils.Utilities.substitute(x, values), sample))
+        print(" {: <11}| {: <19.1f}| {: <19.1f}| {:.1f}x".format(count, old, new, old / new))
+
+# === Data path suite === #
+
+roles = ["member", "member", "member", "moderator", "admin"]
+
+def generateUsers(count, start = 0):
+    """Yields 'count' synthetic user records with IDs counting up from 'start'. Uses the global random state, so seed it for repeatable data."""
+    for x in range(start, start + count):
+        yield {"id": f"id{x:08}", "username": f"user{x}", "pwhash": "0" * 64, "nickname": f"nick{x}", "role": random.choice(roles), "creation": 1542412800000 + x, "locked": "true" if random.random() < 0.01 else "false"}
+
+def connectStandIn(size):
+    """Connects to a fresh in-memory SQLite database holding 'size' synthetic users and returns how long the import took in seconds."""
+    info = cm.DatabaseInfo(None, None, ":memory:", None, None, "sqlite")
+    with contextlib.redirect_stdout(io.StringIO()):
+        if not info.attemptConnection():
+            raise RuntimeError("Could not open the stand-in database.")
+        cm.CredentialManager.setup()
+    cm.CredentialManager.setCache(cm.UserCache(maxEntries = 0, ttl = 0))
+    cm.CredentialManager.availabilityCache = None
+    start = time.perf_counter()
+    cm.CredentialManager.importUsers(generateUsers(size))
+    return time.perf_counter() - start
+
+def disconnectStandIn():
+    """Closes the stand-in database, dropping it and everything cached from it."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        cm.CredentialManager.gracefulExit()
+
+def benchmarkScript(lines):
+    """Runs a generated script of 'lines' commands through CommandProcessor2 and returns the average nanoseconds per command."""
+    processor = jutils.CommandProcessor2({})
+    processor.registerCommands([jutils.RunScriptCommand(processor), jutils.DefineCommand(), jutils.DefineIntCommand(), jutils.AddCommand(), jutils.CompareCommand(), jutils.ConditionalCommand(processor), jutils.PrintCommand(), cm.DetailUserCommand()])
+    header = ["defint counter 0", "defint over 0"]
+    body = ["add counter 1", "compare counter > 100", "conditional results true \"add over 1\"", "define last %counter%", "print %last% %over%", "detailuser user1"]
+    # Output is hidden while the script runs, so a misspelled command would quietly time the "Unknown command" path instead.
+    unknown = [x for x in (jutils.Utilities.parseCommand(y)[0] for y in header + body) if processor.getExactCommandByName(x) == None]
+    if len(unknown) > 0:
+        raise ValueError(f"The benchmark script uses unknown commands: {', '.join(unknown)}")
+    filename = "benchmark-script.txt"
+    with open(filename, "w") as fileWrite:
+        fileWrite.write("\n".join(header + [body[x % len(body)] for x in range(0, lines)]) + "\n")
+    try:
+        jutils.storedVariables.clear()
+        start = time.perf_counter_ns()
+        with contextlib.redirect_stdout(io.StringIO()):
+            processor.executeCommand("run", [filename])
+            while processor.executeNextInQueue():
+                pass
+        return (time.perf_counter_ns() - start) / (lines + 2)
+    finally:
+        os.remove(filename)
+
+def benchmarkDataPath(size, lookups = 10000, writes = 1000, scriptLines = 10000, repeat = 3):
+    """Runs every data path benchmark against a stand-in database of 'size' users and returns a list of results.
+Read-only benchmarks are run 'repeat' times and keep their best time, writes only run once since they change the data."""
+    CM = cm.CredentialManager
+    results = []
+    record = lambda name, value, unit = "ns/op": results.append({"benchmark": name, "size": size, "value": round(value, 3), "unit": unit})
+
+    record("import", connectStandIn(size) * 1e9 / size)
+    try:
+        sample = [random.randrange(0, size) for x in range(0, lookups)]
+        record("getUserById.miss", bestOf(repeat, lambda: timePerCall(lambda x: CM.getUserById(x, False), [f"id{x:08}" for x in sample])))
+        record("getUserByName.miss", bestOf(repeat, lambda: timePerCall(lambda x: CM.getUserByName(x, False), [f"user{x}" for x in sample])))
+        record("getUserById.hit", bestOf(repeat, lambda: timePerCall(CM.getUserById, [f"id{x:08}" for x in sample])))
+        record("getUserByName.hit", bestOf(repeat, lambda: timePerCall(CM.getUserByName, [f"user{x}" for x in sample])))
+
+        newUsers = [cm.User(f"new{x:08}", f"newuser{x}", None, "member", 0, False) for x in range(0, writes)]
+        for user in newUsers:
+            user.setPasswordHash("0" * 64)
+        record("createUser", timePerCall(CM.createUser, newUsers))
+
+        users = list(CM.getUsersByIds([f"id{x:08}" for x in random.sample(range(0, size), min(size, writes))]).values())
+        def update(user):
+            user.setNickname("updated")
+            CM.updateUser(user)
+        record("updateUser", timePerCall(update, users))
+
+        for user in users:
+            user.setRole("moderator")
+        start = time.perf_counter_ns()
+        CM.flush()
+        record("flush", (time.perf_counter_ns() - start) / len(users))
+
+        elapsed = bestOf(repeat, lambda: timePerCall(lambda x: CM.getUserInfoList(), [None]))
+        record("getUserInfoList", elapsed / 1e6, "ms")
+        record("getUserInfoList.perUser", elapsed / size)
+
+        record("script", bestOf(repeat, lambda: benchmarkScript(scriptLines)))
+    finally:
+        disconnectStandIn()
+    return results
+
+def compareToBaseline(results, baseline, threshold):
+    """Prints each result next to its baseline and returns the results that got slower by more than 'threshold' percent."""
+    previous = {(x["benchmark"], x["size"]): x["value"] for x in baseline["results"]}
+    regressions = []
+    print("{:^26}|{:^10}|{:^20}|{:^20}|{:^10}".format("Benchmark", "Users", "Baseline", "Current", "Change"))
+    print("-" * 90)
+    for result in results:
+        old = previous.get((result["benchmark"], result["size"]), None)
+        change = (result["value"] - old) / old * 100 if old != None and old > 0 else None
+        flag = " REGRESSION" if change != None and change > threshold else ""
+        print(" {: <25}| {: <9}| {: <19}| {: <19}| {}{}".format(result["benchmark"], result["size"], "-" if old == None else f"{old} {result['unit']}", f"{result['value']} {result['unit']}", "-" if change == None else f"{change:+.1f}%", flag))
+        if flag != "":
+            regressions.append(result)
+    return regressions
+
+def runDataPath(sizes, seed = 0, output = None, baseline = None, threshold = 25.0):
+    """Runs the data path suite at each table size, optionally saving the results and comparing them against a baseline file.\nReturns the number of regressions found."""
+    random.seed(seed)
+    results = []
+    for size in sizes:
+        print(f"Benchmarking {size} users...")
+        results += benchmarkDataPath(size)
+
+    report = {"created": jutils.Utilities.getSystemTimeString(), "python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "platform": platform.platform(), "seed": seed, "results": results}
+    if output != None:
+        with open(output, "w") as fileWrite:
+            json.dump(report, fileWrite, indent = 2)
+
+    if baseline != None:
+        with open(baseline, "r") as fileRead:
+            regressions = compareToBaseline(results, json.load(fileRead), threshold)
+        print(f"\n{len(regressions)} regression(s) above {threshold}%.")
+        return len(regressions)
+
+    print("{:^26}|{:^10}|{:^20}".format("Benchmark", "Users", "Result"))
+    print("-" * 58)
+    for result in results:
+        print(" {: <25}| {: <9}| {} {}".format(result["benchmark"], result["size"], result["value"], result["unit"]))
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks the CredentialManager data path.")
+    parser.add_argument("suite", nargs = "?", default = "data", choices = ["data", "cache", "hashing", "substitution"])
+    parser.add_argument("--sizes", nargs = "+", type = int, default = None, help = "table or cache sizes to benchmark (1000 to 1000000)")
+    parser.add_argument("--seed", type = int, default = 0, help = "seed for the synthetic data")
+    parser.add_argument("--output", default = None, help = "file to save the results to as JSON")
+    parser.add_argument("--baseline", default = None, help = "JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type = float, default = 25.0, help = "percent slowdown reported as a regression")
+    args = parser.parse_args()
+
+    if args.suite == "hashing":
+        benchmarkHashing()
+    elif args.suite == "substitution":
+        benchmarkSubstitution(tuple(args.sizes) if args.sizes != None else (10, 1000, 100000))
+    elif args.suite == "cache":
+        benchmarkCacheHits(tuple(args.sizes) if args.sizes != None else (10000, 100000, 1000000))
+    else:
+        sys.exit(1 if runDataPath(args.sizes if args.sizes != None else [1000, 10000, 100000], args.seed, args.output, args.baseline, args.threshold) > 0 else 0)
@@ -46,210 +46,1467 @@
 # - There is a slight change in how user data is saved when gracefully closing the connection.
 
 import JUtils2 as jutils
-import msvcrt
+import concurrent.futures
+import contextlib
+import functools
+import asyncio
+import threading
+import collections
+import itertools
+import json
+import hmac
 import csv
 import sys
+import sqlite3
+import time
+import re
 import os
 
+# The MySQL connector is only required when connecting to a MySQL server; SQLite databases work without it.
 try:
     import mysql.connector as sql
 except:
-    print("\n[ERROR] The 'MySQL Connector for Python' module is missing!\nYou can download it from here: https://dev.mysql.com/downloads/connector/python/\n")
-    while True:
-        pass
+    sql = None
+
+# msvcrt is only available on Windows. Without it, confirmations are read from regular input instead.
+try:
+    import msvcrt
+except:
+    msvcrt = None
 
 info = None
-connection = None
-cursor = None
+backend = None
+pool = None
+replicas = None
 
 # === Primary classes and functions == #
 
 class DatabaseInfo():
+    # The first line of a config file is either "ip,port,database,username,password" for a MySQL server or "sqlite,path" for a local SQLite database.
+    # MySQL configs may list read replicas on the following lines as "replica,ip,port" or "replica,ip,port,database,username,password";
+    # a replica without its own database and login uses the primary's.
     def getFromFile(database = "database.config"):
         try:
             data = []
             with open(f"{database}" if database.endswith(".config") else f"{database}.config", "r") as fileRead:
                 fileContents = csv.reader(fileRead, delimiter=",")
-                data = list(fileContents)[0]
-            return DatabaseInfo(data[0], data[1], data[2], data[3], data[4])
+                lines = [x for x in fileContents if len(x) > 0]
+                data = lines[0]
+            if data[0].lower() == "sqlite":
+                return DatabaseInfo(None, None, data[1] if len(data) > 1 else "credentials.db", None, None, "sqlite")
+            info = DatabaseInfo(data[0], data[1], data[2], data[3], data[4])
+            for line in lines[1:]:
+                if line[0].lower() == "replica":
+                    info.replicas.append(DatabaseInfo(line[1], line[2], *(line[3:6] if len(line) >= 6 else data[2:5])))
+            return info
         except:
             return None
-    
-    def __init__(self, ip, port, database, username, password):
+
+    def __init__(self, ip, port, database, username, password, engine = "mysql"):
         self.ip = ip
         self.port = port
         self.database = database
+        self.engine = engine
+        self.replicas = []
         self.__username = username
         self.__password = password
 
+    # Settings used for the connection pool, all times are in milliseconds.
+    poolSettings = {"minSize": 1, "maxSize": 8, "idleTimeout": 300000, "checkoutTimeout": 10000, "healthCheckInterval": 30000}
+
     def getDatabase(self):
         return (self.ip, self.port, self.database)
 
+    def connect(self):
+        return sql.connect(host=self.ip,port=self.port,database=self.database,user=self.__username,passwd=self.__password,autocommit=True)
+
+    def getBackend(self):
+        return SQLiteBackend(self.database) if self.engine == "sqlite" else MySQLBackend(self)
+
     def attemptConnection(self):
-        global connection
-        global cursor
+        global backend
+        global pool
+        global replicas
+        if self.engine != "sqlite" and sql == None:
+            print("\n[ERROR] The 'MySQL Connector for Python' module is missing!\nYou can download it from here: https://dev.mysql.com/downloads/connector/python/\n")
+            return False
         try:
-            connection = sql.connect(host=self.ip,port=self.port,database=self.database,user=self.__username,passwd=self.__password)
-            cursor = connection.cursor()
+            newBackend = self.getBackend()
+            newPool = ConnectionPool(newBackend.connect, validate = newBackend.validate, connectionErrors = newBackend.connectionErrors, isConnectionError = newBackend.isConnectionError, **self.poolSettings)
+            if pool != None:
+                pool.close()
+                backend.close()
+            if replicas != None:
+                replicas.close()
+            backend = newBackend
+            pool = newPool
+            replicas = ReplicaRouter(self.replicas, self.poolSettings) if len(self.replicas) > 0 else None
             return True
         except:
-            if connection != None:
-                connection.close()
-                connection = None
             jutils.Utilities.logTracebackToFile("errors.log")
             return False
 
+# === Storage backends === #
+
+class StorageBackend():
+    # A backend opens connections to one kind of database and smooths over its SQL dialect, so CredentialManager can stay database agnostic.
+    # On its own it wraps any function returning a DB-API connection that understands MySQL style SQL, such as a driver's connect().
+    # Statements are written with MySQL style '%(name)s' placeholders and translated by backends that use another style.
+    # Each entry of 'schemaMigrations' is (version, description, check, statements). 'check' looks at the current table layout and returns
+    # True if the migration is already in place, which lets us adopt tables that were created (or hand-indexed) before versioning existed.
+    connectionErrors = ()
+    integrityErrors = ()
+    beginStatement = "START TRANSACTION"
+    schemaMigrations = []
+    # Whether independent write transactions may run on several connections at once. Databases with a single writer should turn this off.
+    parallelWrites = True
+
+    def __init__(self, connect = None):
+        self.__connect = connect
+        self.__statementStats = {"prepared": 0, "reused": 0, "evicted": 0}
+        self.__statementLock = threading.Lock()
+
+    def connect(self):
+        return self.__connect()
+
+    # Returns True if 'error', one of 'connectionErrors', means the connection was lost rather than that the statement was wrong.
+    def isConnectionError(self, error):
+        return isinstance(error, self.connectionErrors)
+
+    def validate(self, connection):
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+
+    def translate(self, statement):
+        return statement
+
+    # Returns the translated statement and its parameters in the form the driver expects.
+    def bind(self, statement, params):
+        return (self.translate(statement), params if params != None else ())
+
+    # Returns the PreparedStatement for 'statement' on this pooled connection, preparing it the first time the connection sees that query shape.
+    # Each connection keeps at most 'statementCacheSize' statements, dropping the least recently used.
+    statementCacheSize = 64
+
+    def getPreparedStatement(self, pooled, statement):
+        prepared = pooled.statements.get(statement, None)
+        if prepared != None:
+            pooled.statements.move_to_end(statement)
+            self.__countStatement("reused")
+            return prepared
+
+        prepared = self.prepare(pooled.connection, statement)
+        pooled.statements[statement] = prepared
+        self.__countStatement("prepared")
+        while len(pooled.statements) > self.statementCacheSize:
+            pooled.statements.popitem(last = False)[1].close()
+            self.__countStatement("evicted")
+        return prepared
+
+    def prepare(self, connection, statement):
+        return PreparedStatement(connection.cursor(), self.translate(statement))
+
+    def __countStatement(self, key):
+        with self.__statementLock:
+            self.__statementStats[key] += 1
+
+    def getStatementStats(self):
+        with self.__statementLock:
+            stats = dict(self.__statementStats)
+        total = stats["prepared"] + stats["reused"]
+        return {"statementsPrepared": stats["prepared"], "statementsReused": stats["reused"], "statementsEvicted": stats["evicted"], "statementReuseRate": round(stats["reused"] / total, 3) if total > 0 else 0.0}
+
+    # Returns {"exists": bool, "indexes": {name: [columns]}, "unique": set of unique index names}, with the primary key named "PRIMARY".
+    # There is no portable way to list indexes, so by default we only find out whether the table exists. Backends with migrations override this.
+    def getSchemaLayout(self, execute):
+        try:
+            execute("SELECT id FROM `Credential_Table` WHERE 1 = 0")
+            return {"exists": True, "indexes": {}, "unique": set()}
+        except:
+            return {"exists": False, "indexes": {}, "unique": set()}
+
+    # Returns the column ("id" or "username") whose unique constraint an integrity error broke, or None for any other error.
+    def conflictColumn(self, error):
+        return None
+
+    def close(self):
+        pass
+
+class MySQLBackend(StorageBackend):
+    # Index changes are applied online so the table stays readable and writable while they are built.
+    schemaMigrations = [
+        (1, "Create the credential table", lambda layout: layout["exists"], ["CREATE TABLE IF NOT EXISTS `Credential_Table` (id VARCHAR(16) NOT NULL, username VARCHAR(16) NOT NULL, pwhash VARCHAR(256), nickname VARCHAR(16), role VARCHAR(16), creation BIGINT, locked BOOLEAN, PRIMARY KEY (id), UNIQUE INDEX `username_index` (username))"]),
+        (2, "Add a primary key on id", lambda layout: "PRIMARY" in layout["indexes"], ["ALTER TABLE `Credential_Table` MODIFY id VARCHAR(16) NOT NULL, ADD PRIMARY KEY (id), ALGORITHM=INPLACE, LOCK=NONE"]),
+        (3, "Add a unique index on username", lambda layout: ["username"] in [layout["indexes"][x] for x in layout["unique"]], ["ALTER TABLE `Credential_Table` ADD UNIQUE INDEX `username_index` (username), ALGORITHM=INPLACE, LOCK=NONE"])
+    ]
+
+    def __init__(self, info):
+        StorageBackend.__init__(self, info.connect)
+        self.info = info
+        self.connectionErrors = (sql.OperationalError, sql.InterfaceError)
+        self.integrityErrors = (sql.IntegrityError,)
+
+    def validate(self, connection):
+        connection.ping(reconnect = False)
+
+    # Server-side prepared statements use positional placeholders, so the named parameters are remembered in order.
+    def prepare(self, connection, statement):
+        return PreparedStatement(connection.cursor(prepared = True), re.sub(r"%\((\w+)\)s", "%s", statement), re.findall(r"%\((\w+)\)s", statement))
+
+    def getSchemaLayout(self, execute):
+        layout = {"exists": len(execute("SHOW TABLES LIKE 'Credential_Table'")) > 0, "indexes": {}, "unique": set()}
+        if layout["exists"]:
+            # SHOW INDEX returns one row per indexed column: (Table, Non_unique, Key_name, Seq_in_index, Column_name, ...)
+            for row in sorted(execute("SHOW INDEX FROM `Credential_Table`"), key = lambda x: (x[2], x[3])):
+                layout["indexes"].setdefault(row[2], []).append(row[4])
+                if not row[1]:
+                    layout["unique"].add(row[2])
+        return layout
+
+    # Duplicate key errors (errno 1062) name the index, "Duplicate entry '...' for key '[table.]name'", which we map to its column.
+    uniqueKeys = {"PRIMARY": "id", "username_index": "username"}
+
+    def conflictColumn(self, error):
+        if getattr(error, "errno", None) != 1062:
+            return None
+        match = re.search(r"for key '(?:[^']*\.)?([^'.]+)'", str(getattr(error, "msg", None) or error))
+        return MySQLBackend.uniqueKeys.get(match.group(1), None) if match != None else None
+
+class SQLiteBackend(StorageBackend):
+    # An embedded database for single-node deployments and tests. File databases use WAL mode so readers never wait on the writer.
+    # ":memory:" gives a private in-memory database that is shared by every pooled connection for as long as the backend is open.
+    connectionErrors = (sqlite3.ProgrammingError,)
+    integrityErrors = (sqlite3.IntegrityError,)
+    beginStatement = "BEGIN"
+    parallelWrites = False
+    schemaMigrations = [
+        (1, "Create the credential table", lambda layout: layout["exists"], ["CREATE TABLE IF NOT EXISTS `Credential_Table` (id VARCHAR(16) NOT NULL PRIMARY KEY, username VARCHAR(16) NOT NULL, pwhash VARCHAR(256), nickname VARCHAR(16), role VARCHAR(16), creation BIGINT, locked BOOLEAN)", "CREATE UNIQUE INDEX IF NOT EXISTS `username_index` ON `Credential_Table` (username)"]),
+        # SQLite can't add a primary key to an existing table, so the table is rebuilt instead.
+        (2, "Add a primary key on id", lambda layout: "PRIMARY" in layout["indexes"], ["CREATE TABLE `Credential_Table_New` (id VARCHAR(16) NOT NULL PRIMARY KEY, username VARCHAR(16), pwhash VARCHAR(256), nickname VARCHAR(16), role VARCHAR(16), creation BIGINT, locked BOOLEAN)", "INSERT INTO `Credential_Table_New` SELECT id,username,pwhash,nickname,role,creation,locked FROM `Credential_Table`", "DROP TABLE `Credential_Table`", "ALTER TABLE `Credential_Table_New` RENAME TO `Credential_Table`"]),
+        (3, "Add a unique index on username", lambda layout: ["username"] in [layout["indexes"][x] for x in layout["unique"]], ["CREATE UNIQUE INDEX IF NOT EXISTS `username_index` ON `Credential_Table` (username)"])
+    ]
+    __memoryDatabases = 0
+
+    # sqlite3 compiles statements through its own per-connection cache, which we size to match our statement cache.
+    def __init__(self, path = "credentials.db"):
+        StorageBackend.__init__(self)
+        self.path = path
+        self.__keepAlive = None
+        self.__translations = {}
+        if path == ":memory:":
+            SQLiteBackend.__memoryDatabases += 1
+            self.path = f"file:credentialmanager-{os.getpid()}-{SQLiteBackend.__memoryDatabases}?mode=memory&cache=shared"
+            # A shared in-memory database disappears when its last connection closes, so we hold one open.
+            self.__keepAlive = self.connect()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout = 10, isolation_level = None, check_same_thread = False, uri = self.path.startswith("file:"), cached_statements = max(128, self.statementCacheSize))
+        if not self.path.startswith("file:"):
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    # Named parameters are turned into positional '?' ones. SQLite looks up each ':name' against every name before it while compiling,
+    # which makes large multi-row statements take quadratic time; positional parameters compile in linear time.
+    def __translate(self, statement):
+        translated = self.__translations.get(statement, None)
+        if translated == None:
+            translated = (re.sub(r"%\((\w+)\)s", "?", statement), re.findall(r"%\((\w+)\)s", statement))
+            self.__translations[statement] = translated
+        return translated
+
+    def translate(self, statement):
+        return self.__translate(statement)[0]
+
+    # sqlite3 raises ProgrammingError for bad SQL and parameters too, so only "Cannot operate on a closed database." means the connection is gone.
+    def isConnectionError(self, error):
+        return isinstance(error, sqlite3.ProgrammingError) and "closed database" in str(error)
+
+    def bind(self, statement, params):
+        translated, names = self.__translate(statement)
+        return (translated, tuple(params[x] for x in names) if isinstance(params, dict) else (params if params != None else ()))
+
+    def prepare(self, connection, statement):
+        translated, names = self.__translate(statement)
+        return PreparedStatement(connection.cursor(), translated, names)
+
+    def getSchemaLayout(self, execute):
+        layout = {"exists": len(execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'Credential_Table'")) > 0, "indexes": {}, "unique": set()}
+        if layout["exists"]:
+            # index_list returns (seq, name, unique, origin, partial); origin is 'pk' for the primary key's index.
+            for index in execute("PRAGMA index_list(`Credential_Table`)"):
+                name = "PRIMARY" if index[3] == "pk" else index[1]
+                layout["indexes"][name] = [x[2] for x in sorted(execute(f"PRAGMA index_info(`{index[1]}`)"))]
+                if index[2]:
+                    layout["unique"].add(name)
+        return layout
+
+    # Unique and primary key violations read "UNIQUE constraint failed: Credential_Table.column".
+    def conflictColumn(self, error):
+        match = re.fullmatch(r"UNIQUE constraint failed: (?:Credential_Table\.)?(\w+)", str(error))
+        return match.group(1) if match != None and match.group(1) in ("id", "username") else None
+
+    def close(self):
+        if self.__keepAlive != None:
+            self.__keepAlive.close()
+            self.__keepAlive = None
+
+class PreparedStatement():
+    # A cursor dedicated to one statement. 'names' lists the parameters in placeholder order for backends that need positional values.
+    def __init__(self, cursor, statement, names = None):
+        self.cursor = cursor
+        self.statement = statement
+        self.names = names
+
+    def execute(self, params = None):
+        if self.names != None:
+            params = tuple(params[x] for x in self.names) if params != None else ()
+        self.cursor.execute(self.statement, params if params != None else ())
+        return self.cursor.fetchall() if self.cursor.description != None else None
+
+    def close(self):
+        try:
+            self.cursor.close()
+        except:
+            pass
+
+class BackendCursor():
+    # Wraps a DB-API cursor so statements are translated for the backend before they are run.
+    def __init__(self, cursor, backend):
+        self.cursor = cursor
+        self.backend = backend
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def execute(self, statement, params = None):
+        self.cursor.execute(*self.backend.bind(statement, params))
+
+    def executemany(self, statement, params):
+        self.cursor.executemany(self.backend.translate(statement), [self.backend.bind(statement, x)[1] for x in params])
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def close(self):
+        self.cursor.close()
+
+class ReplicaRouter():
+    # Spreads reads across read replicas, either "round-robin" or "least-latency" (lowest moving average of query time).
+    # A replica that fails 'maxFailures' times in a row is ejected for 'ejectionTime' milliseconds and then given another chance.
+    policy = "round-robin"
+    maxFailures = 3
+    ejectionTime = 30000
+
+    def __init__(self, replicaInfos, poolSettings):
+        self.replicas = []
+        self.__next = 0
+        self.__lock = threading.Lock()
+        for replicaInfo in replicaInfos:
+            replica = Replica(replicaInfo)
+            try:
+                replica.backend = replicaInfo.getBackend()
+                replica.pool = ConnectionPool(replica.backend.connect, validate = replica.backend.validate, connectionErrors = replica.backend.connectionErrors, isConnectionError = replica.backend.isConnectionError, **dict(poolSettings, minSize = 0))
+            except:
+                jutils.Utilities.logTracebackToFile("errors.log")
+                replica.ejectedUntil = jutils.Utilities.getSystemTime() + self.ejectionTime
+            self.replicas.append(replica)
+
+    # Returns the replica the next read should use, or None if every replica is ejected and the read should go to the primary.
+    def choose(self):
+        now = jutils.Utilities.getSystemTime()
+        with self.__lock:
+            available = [x for x in self.replicas if x.pool != None and x.ejectedUntil <= now]
+            if len(available) == 0:
+                return None
+            if self.policy == "least-latency":
+                return min(available, key = lambda x: x.latency)
+            self.__next = (self.__next + 1) % len(available)
+            return available[self.__next]
+
+    def reportSuccess(self, replica, elapsed):
+        with self.__lock:
+            replica.reads += 1
+            replica.failures = 0
+            replica.latency = elapsed if replica.reads == 1 else replica.latency * 0.8 + elapsed * 0.2
+
+    def reportFailure(self, replica):
+        with self.__lock:
+            replica.failures += 1
+            replica.totalFailures += 1
+            if replica.failures >= self.maxFailures:
+                replica.failures = 0
+                replica.ejections += 1
+                replica.ejectedUntil = jutils.Utilities.getSystemTime() + self.ejectionTime
+
+    def getStats(self):
+        now = jutils.Utilities.getSystemTime()
+        with self.__lock:
+            return [{"replica": f"{x.info.ip}:{x.info.port}", "healthy": x.pool != None and x.ejectedUntil <= now, "reads": x.reads, "latency": round(x.latency, 3), "failures": x.totalFailures, "ejections": x.ejections} for x in self.replicas]
+
+    def close(self):
+        for replica in self.replicas:
+            if replica.pool != None:
+                replica.pool.close()
+                replica.backend.close()
+
+class Replica():
+    def __init__(self, info):
+        self.info = info
+        self.backend = None
+        self.pool = None
+        self.reads = 0
+        self.latency = 0.0
+        self.failures = 0
+        self.totalFailures = 0
+        self.ejections = 0
+        self.ejectedUntil = 0
+
+class PoolTimeoutError(Exception):
+    pass
+
+class PooledConnection():
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = jutils.Utilities.getSystemTime()
+        self.lastUsed = self.created
+        # Prepared statements for this connection, keyed by statement text and ordered from least to most recently used.
+        self.statements = collections.OrderedDict()
+
+class ConnectionPool():
+    # 'connect' is any function returning a new DB-API connection, so the pool works with any backend (or a local stand-in).
+    # Errors of a 'connectionErrors' type that 'isConnectionError' accepts (all of them by default) mean the connection was lost.
+    # Connections are validated when they are checked out after being idle for longer than 'healthCheckInterval'.
+    # Once a connection fails, every connection that was idle at the time is validated on its next checkout too, since a dropped
+    # server usually takes all of them down at once.
+    def __init__(self, connect, minSize = 1, maxSize = 8, idleTimeout = 300000, checkoutTimeout = 10000, healthCheckInterval = 30000, validate = None, connectionErrors = (Exception,), isConnectionError = None):
+        self.__connect = connect
+        self.__validate = validate if validate != None else ConnectionPool.__selectOne
+        self.connectionErrors = connectionErrors
+        self.__isConnectionError = isConnectionError
+        self.minSize = minSize
+        self.maxSize = max(minSize, maxSize)
+        self.idleTimeout = idleTimeout
+        self.checkoutTimeout = checkoutTimeout
+        self.healthCheckInterval = healthCheckInterval
+        self.__idle = collections.deque()
+        self.__size = 0
+        self.__inUse = 0
+        self.__closed = False
+        self.__suspectSince = 0
+        self.__condition = threading.Condition()
+        self.__stats = {"checkouts": 0, "timeouts": 0, "created": 0, "discarded": 0, "expired": 0, "probes": 0, "failedProbes": 0, "peakInUse": 0, "totalWaitTime": 0.0, "maxWaitTime": 0.0}
+
+        for x in range(0, minSize):
+            self.__idle.append(PooledConnection(self.__connect()))
+            self.__size += 1
+            self.__stats["created"] += 1
+
+    def isConnectionError(self, error):
+        return isinstance(error, self.connectionErrors) and (self.__isConnectionError == None or self.__isConnectionError(error))
+
+    def __selectOne(connection):
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+
+    # With 'fresh' set, a new connection is always opened instead of reusing an idle one, closing an idle one if the pool is full.
+    def acquire(self, timeout = None, fresh = False):
+        timeout = self.checkoutTimeout if timeout == None else timeout
+        start = time.perf_counter()
+        pooled = None
+        with self.__condition:
+            while True:
+                if self.__closed:
+                    raise PoolTimeoutError("The connection pool has been closed.")
+                self.__pruneIdle()
+                if fresh and len(self.__idle) > 0 and self.__size >= self.maxSize:
+                    ConnectionPool.__closeQuietly(self.__idle.popleft())
+                    self.__size -= 1
+                    self.__stats["discarded"] += 1
+                if not fresh and len(self.__idle) > 0:
+                    pooled = self.__idle.pop()
+                    break
+                if self.__size < self.maxSize:
+                    self.__size += 1
+                    break
+                remaining = timeout / 1000 - (time.perf_counter() - start)
+                if remaining <= 0:
+                    self.__stats["timeouts"] += 1
+                    raise PoolTimeoutError(f"No connection became available within {timeout}ms.")
+                self.__condition.wait(remaining)
+            self.__inUse += 1
+            self.__stats["peakInUse"] = max(self.__stats["peakInUse"], self.__inUse)
+
+        try:
+            pooled = self.__checkHealth(pooled)
+        except:
+            with self.__condition:
+                self.__size -= 1
+                self.__inUse -= 1
+                self.__condition.notify()
+            raise
+
+        waited = (time.perf_counter() - start) * 1000
+        with self.__condition:
+            self.__stats["checkouts"] += 1
+            self.__stats["totalWaitTime"] += waited
+            self.__stats["maxWaitTime"] = max(self.__stats["maxWaitTime"], waited)
+        return pooled
+
+    def __checkHealth(self, pooled):
+        # Connections are created, replaced or probed outside of the lock so other workers are not held up.
+        if pooled != None:
+            idleTime = jutils.Utilities.getSystemTime() - pooled.lastUsed
+            if idleTime > self.idleTimeout:
+                self.__count("expired")
+                ConnectionPool.__closeQuietly(pooled)
+                pooled = None
+            elif idleTime > self.healthCheckInterval or pooled.lastUsed <= self.__suspectSince:
+                self.__count("probes")
+                try:
+                    self.__validate(pooled.connection)
+                except:
+                    self.__count("failedProbes")
+                    ConnectionPool.__closeQuietly(pooled)
+                    pooled = None
+        if pooled == None:
+            pooled = PooledConnection(self.__connect())
+            self.__count("created")
+        return pooled
+
+    def __count(self, key):
+        with self.__condition:
+            self.__stats[key] += 1
+
+    # Marks every idle connection to be validated before it is handed out again.
+    def suspectIdle(self):
+        with self.__condition:
+            self.__suspectSince = jutils.Utilities.getSystemTime()
+
+    def release(self, pooled, discard = False):
+        with self.__condition:
+            self.__inUse -= 1
+            if discard or self.__closed:
+                self.__size -= 1
+                self.__stats["discarded"] += 1 if discard else 0
+                ConnectionPool.__closeQuietly(pooled)
+            else:
+                pooled.lastUsed = jutils.Utilities.getSystemTime()
+                self.__idle.append(pooled)
+            self.__condition.notify()
+
+    # Borrow a PooledConnection for the duration of a 'with' block. Connections that are lost are discarded instead of returned,
+    # and the idle connections are marked to be validated before they are used again.
+    @contextlib.contextmanager
+    def borrow(self, timeout = None, fresh = False):
+        pooled = self.acquire(timeout, fresh)
+        try:
+            yield pooled
+        except self.connectionErrors as e:
+            if not self.isConnectionError(e):
+                self.release(pooled)
+                raise
+            self.release(pooled, True)
+            self.suspectIdle()
+            raise
+        except:
+            self.release(pooled)
+            raise
+        else:
+            self.release(pooled)
+
+    def __pruneIdle(self):
+        # The oldest idle connections sit at the left of the deque, so we only ever need to look there.
+        now = jutils.Utilities.getSystemTime()
+        while self.__size > self.minSize and len(self.__idle) > 0 and now - self.__idle[0].lastUsed > self.idleTimeout:
+            ConnectionPool.__closeQuietly(self.__idle.popleft())
+            self.__size -= 1
+            self.__stats["expired"] += 1
+
+    def __closeQuietly(pooled):
+        try:
+            pooled.connection.close()
+        except:
+            pass
+
+    def isClosed(self):
+        return self.__closed
+
+    def close(self):
+        with self.__condition:
+            self.__closed = True
+            while len(self.__idle) > 0:
+                ConnectionPool.__closeQuietly(self.__idle.pop())
+                self.__size -= 1
+            self.__condition.notify_all()
+
+    def getStats(self):
+        with self.__condition:
+            stats = dict(self.__stats)
+            stats.update({"size": self.__size, "idle": len(self.__idle), "inUse": self.__inUse, "utilization": round(self.__inUse / self.maxSize, 3), "peakUtilization": round(self.__stats["peakInUse"] / self.maxSize, 3), "averageWaitTime": round(self.__stats["totalWaitTime"] / max(1, self.__stats["checkouts"]), 3)})
+            return stats
+
+class UserCache():
+    # Holds recently used users in a bounded LRU cache, keyed by unique ID, with a username index on the side so name lookups are constant time.
+    # Limits of 0 mean no limit, and 'ttl' is in milliseconds. Users that were modified but not saved are passed to 'writeBack' when evicted.
+    # Anything with the same methods can be plugged in with CredentialManager.setCache().
+    def __init__(self, maxEntries = 100000, maxBytes = 0, ttl = 300000, writeBack = None):
+        self.__users = jutils.LRUCache(maxEntries, maxBytes, ttl, UserCache.__sizeOf, self.__onEvict)
+        self.__usernameIndex = {}
+        self.__indexedNames = {}
+        self.__lock = threading.RLock()
+        self.writeBack = writeBack
+
+    def __sizeOf(user):
+        return sys.getsizeof(user) + sum(map(sys.getsizeof, vars(user).values()))
+
+    def getById(self, userId):
+        return self.__users.get(userId)
+
+    def getByName(self, username):
+        userId = self.__usernameIndex.get(username, None)
+        user = self.__users.get(userId) if userId != None else None
+        # The username is checked again in case the cached user was renamed after being indexed.
+        return user if user != None and user.getUsername() == username else None
+
+    # A modified user that is replaced by another copy is written back first, as it would be if it were evicted,
+    # and the columns it saved are copied onto the new copy unless that one changed them too.
+    def put(self, user):
+        with self.__lock:
+            previous = self.__users.pop(user.getUniqueID())
+            if previous != None:
+                self.__unindex(previous)
+        if previous != None and previous is not user and previous.isDirty() and self.writeBack != None:
+            fields = previous.getModifiedFields() - user.getModifiedFields() - {"pwhash"}
+            self.writeBack(previous)
+            if not previous.isDirty():
+                user.applySavedFields({x: getattr(previous, x) for x in fields})
+        with self.__lock:
+            self.__usernameIndex[user.getUsername()] = user.getUniqueID()
+            self.__indexedNames[user.getUniqueID()] = user.getUsername()
+        self.__users.put(user.getUniqueID(), user)
+
+    def remove(self, user):
+        with self.__lock:
+            self.__users.pop(user.getUniqueID())
+            self.__unindex(user)
+
+    def __unindex(self, user):
+        # The user may have been renamed since it was indexed, so we remove it by the name it was indexed under.
+        username = self.__indexedNames.pop(user.getUniqueID(), user.getUsername())
+        if self.__usernameIndex.get(username, None) == user.getUniqueID():
+            self.__usernameIndex.pop(username)
+
+    def __onEvict(self, userId, user):
+        with self.__lock:
+            self.__unindex(user)
+        if user.isDirty() and self.writeBack != None:
+            self.writeBack(user)
+
+    def values(self):
+        return self.__users.values()
+
+    def clear(self):
+        with self.__lock:
+            self.__users.clear()
+            self.__usernameIndex.clear()
+            self.__indexedNames.clear()
+
+    def getStats(self):
+        return self.__users.getStats()
+
 class CredentialManager():
+    # The columns resultsToUser() expects. The password hash is left out since it is never cached.
+    userSelectColumns = "id,username,nickname,role,creation,locked"
+
     # Let's reduce the number of database calls by caching the data locally.
-    __cache = {}
+    __cache = UserCache(writeBack = lambda user: CredentialManager.updateUser(user))
 
     def setup():
-        global cursor
-        cursor.execute("CREATE TABLE IF NOT EXISTS `Credential_Table` (id VARCHAR(16), username VARCHAR(16), pwhash VARCHAR(256), nickname VARCHAR(16), role VARCHAR(16), creation BIGINT, locked BOOLEAN)")
-    
-    # Its a good idea to 'poll' your databases from time to time with selection queries and reopen them if an exception is thrown for a known working connection.
+        CredentialManager.migrateSchema()
+
+    def getSchemaVersion():
+        CredentialManager.execute("CREATE TABLE IF NOT EXISTS `Credential_Schema` (version INT NOT NULL)")
+        results = CredentialManager.execute("SELECT MAX(version) FROM `Credential_Schema`")
+        return results[0][0] if len(results) > 0 and results[0][0] != None else 0
+
+    def getSchemaLayout():
+        global backend
+        return backend.getSchemaLayout(CredentialManager.execute)
+
+    def migrateSchema():
+        global backend
+        version = CredentialManager.getSchemaVersion()
+        for migration in backend.schemaMigrations:
+            if migration[0] <= version:
+                continue
+            try:
+                if not migration[2](CredentialManager.getSchemaLayout()):
+                    print(f"Applying schema migration {migration[0]}: {migration[1]}...")
+                    # MySQL commits DDL implicitly, but on SQLite this keeps a multi-statement migration all-or-nothing.
+                    with CredentialManager.transaction() as cursor:
+                        for statement in migration[3]:
+                            cursor.execute(statement)
+                CredentialManager.execute("INSERT INTO `Credential_Schema` (version) VALUES (%(version)s)", {"version": migration[0]})
+                version = migration[0]
+            except:
+                jutils.Utilities.logTracebackToFile("errors.log")
+                print(f"[WARNING] Schema migration {migration[0]} ({migration[1]}) failed, the table may contain duplicate IDs or usernames. Check errors.log for details.\n")
+                break
+        return version
+
+    # Its a good idea to 'poll' your databases from time to time and reopen them if an exception is thrown for a known working connection.
     # From my experience, most databases automatically close connections after long periods of inactivity (24ish hours usually) and begin throwing exceptions.
-    def refreshConnection():
-        global cursor
-        global info
-        try:
-            cursor.execute("SELECT * FROM `Credential_Table`")
-            results = cursor.fetchall()
-        except:
-            connection.close()
-            info.attemptConnection()
-            jutils.Utilities.logTracebackToFile("errors.log")
+    # The pool takes care of this now: connections idle for longer than its 'healthCheckInterval' are probed with a constant-cost ping when checked out.
+    __retries = 0
+
+    # Runs a single statement on a pooled connection and returns its rows (or None for statements without results).
+    # If the connection was dropped, it is discarded and the statement is retried once on a newly opened connection.
+    # Hot statements with a fixed shape should pass 'prepared' so they are prepared once per connection and reused afterwards.
+    # Reads ('read' = True) go to a replica when there is one, unless they involve a user ID or username in 'keys' that this session
+    # has written, in which case they stay on the primary so we always read our own writes. A failing replica falls back to the primary.
+    def execute(statement, params = None, prepared = False, read = False, keys = ()):
+        global backend
+        global pool
+        global replicas
+        if read and replicas != None:
+            if any(x in CredentialManager.__writtenKeys for x in keys):
+                CredentialManager.__pinnedReads += 1
+                return CredentialManager.__executeOn(backend, pool, statement, params, prepared)
+            replica = replicas.choose()
+            if replica != None:
+                start = time.perf_counter()
+                try:
+                    results = CredentialManager.__executeOn(replica.backend, replica.pool, statement, params, prepared)
+                    replicas.reportSuccess(replica, (time.perf_counter() - start) * 1000)
+                    return results
+                except replica.pool.connectionErrors + (PoolTimeoutError,) as e:
+                    if not isinstance(e, PoolTimeoutError) and not replica.pool.isConnectionError(e):
+                        raise
+                    jutils.Utilities.logTracebackToFile("errors.log")
+                    replicas.reportFailure(replica)
+        return CredentialManager.__executeOn(backend, pool, statement, params, prepared)
+
+    # User IDs and usernames written during this session, so reads for them can be pinned to the primary.
+    __writtenKeys = set()
+    __pinnedReads = 0
+
+    def rememberWrite(*users):
+        CredentialManager.rememberWrittenKeys([x.getUniqueID() for x in users], [x.getUsername() for x in users])
+
+    def rememberWrittenKeys(userIds, usernames):
+        CredentialManager.__writeGeneration += 1
+        CredentialManager.__writtenKeys.update(userIds)
+        CredentialManager.__writtenKeys.update(usernames)
+        cache = CredentialManager.verificationCache
+        if cache != None:
+            for username in usernames:
+                cache.pop(username)
+
+    def __executeOn(backend, pool, statement, params, prepared):
+        for attempt in range(2):
+            try:
+                with pool.borrow(fresh = attempt > 0) as pooled:
+                    if prepared:
+                        return backend.getPreparedStatement(pooled, statement).execute(params)
+                    cursor = BackendCursor(pooled.connection.cursor(), backend)
+                    try:
+                        cursor.execute(statement, params)
+                        return cursor.fetchall() if cursor.description != None else None
+                    finally:
+                        cursor.close()
+            except pool.connectionErrors as e:
+                if attempt > 0 or not pool.isConnectionError(e):
+                    raise
+                CredentialManager.__retries += 1
+
+    # Runs several statements on one pooled connection inside a single transaction. The cursor is handed to the 'with' block.
+    @contextlib.contextmanager
+    def transaction():
+        global backend
+        global pool
+        with pool.borrow() as pooled:
+            cursor = BackendCursor(pooled.connection.cursor(), backend)
+            cursor.execute(backend.beginStatement)
+            try:
+                yield cursor
+                pooled.connection.commit()
+            except pool.connectionErrors as e:
+                if not pool.isConnectionError(e):
+                    pooled.connection.rollback()
+                raise
+            except:
+                pooled.connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def getConnectionStats():
+        global backend
+        global pool
+        stats = pool.getStats() if pool != None else {}
+        stats.update(backend.getStatementStats() if backend != None else {})
+        stats.update({"retries": CredentialManager.__retries, "pinnedReads": CredentialManager.__pinnedReads})
+        return stats
+
+    def getReplicaStats():
+        global replicas
+        return replicas.getStats() if replicas != None else []
 
     def gracefulExit():
-        global connection
-        global cursor
+        global backend
+        global pool
+        global replicas
         
-        # Save all cached user data.
-        AdvancedMap(CredentialManager.__cache.values()).forEach(CredentialManager.updateUser)
+        # Save all modified cached user data.
+        CredentialManager.flush()
+
+        pool.close()
+        pool = None
+        backend.close()
+        if replicas != None:
+            replicas.close()
+            replicas = None
+        CredentialManager.__writtenKeys.clear()
+        if CredentialManager.verificationCache != None:
+            CredentialManager.verificationCache.clear()
+        CredentialManager.passwordHasher.close()
+
+        CredentialManager.clearCache()
+
+    def clearCache():
+        CredentialManager.__cache.clear()
 
-        connection.close()
-        cursor.close()
+    def setCache(cache):
+        CredentialManager.__cache = cache
+
+    def getCacheStats():
+        return CredentialManager.__cache.getStats()
+
+    def getCache():
+        return CredentialManager.__cache
+
+    # Results of createUser(). The insert relies on the table's unique constraints, so a conflict is reported instead of racing a separate check.
+    CREATED = "created"
+    ID_TAKEN = "id"
+    USERNAME_TAKEN = "username"
+    FAILED = "failed"
 
-        CredentialManager.__cache.clear()
-        
     def createUser(user):
-        CredentialManager.refreshConnection()
         try:
-            global cursor
-            global connection
-            cursor.execute("INSERT INTO `Credential_Table` (id,username,pwhash,nickname,role,creation,locked) VALUES (%(id)s,%(username)s,%(pwhash)s,%(nickname)s,%(role)s,%(creation)s,%(locked)s)", user.getDictionaryData(True))
-            connection.commit()
+            CredentialManager.execute("INSERT INTO `Credential_Table` (id,username,pwhash,nickname,role,creation,locked) VALUES (%(id)s,%(username)s,%(pwhash)s,%(nickname)s,%(role)s,%(creation)s,%(locked)s)", user.getDictionaryData(True), True)
+            CredentialManager.rememberWrite(user)
+            CredentialManager.__rememberAvailability(user.getUniqueID(), user.getUsername(), False, False)
+            return CredentialManager.CREATED
+        except backend.integrityErrors as e:
+            column = backend.conflictColumn(e)
+            if column == None:
+                jutils.Utilities.logTracebackToFile("errors.log")
+                return CredentialManager.FAILED
+            conflict = CredentialManager.USERNAME_TAKEN if column == "username" else CredentialManager.ID_TAKEN
+            CredentialManager.__rememberAvailability(user.getUniqueID() if conflict == CredentialManager.ID_TAKEN else None, user.getUsername() if conflict == CredentialManager.USERNAME_TAKEN else None, False, False)
+            return conflict
         except:
             jutils.Utilities.logTracebackToFile("errors.log")
             print("An unknown error occurred.")
+            return CredentialManager.FAILED
+
+    # Recently checked IDs and usernames are remembered for a short while so repeated prompts don't query again.
+    # Set 'availabilityCache' to None to always ask the database.
+    availabilityCache = jutils.LRUCache(maxEntries = 10000, ttl = 10000)
+
+    # Returns (is ID available, is username available) using a single indexed query. Either key can be None to skip it.
+    def checkAvailability(userId = None, username = None):
+        cache = CredentialManager.availabilityCache
+        idAvailable = cache.get(("id", userId)) if cache != None and userId != None else None
+        usernameAvailable = cache.get(("username", username)) if cache != None and username != None else None
+        if (userId == None or idAvailable != None) and (username == None or usernameAvailable != None):
+            return (idAvailable, usernameAvailable)
 
-    def isIdAvailable(userId):
-        CredentialManager.refreshConnection()
         try:
-            global cursor
-            cursor.execute("SELECT * FROM `Credential_Table` WHERE id=%(id)s LIMIT 1", {"id": userId})
-            return len(cursor.fetchall()) == 0
+            rows = CredentialManager.execute("SELECT id,username FROM `Credential_Table` WHERE id=%(id)s OR username=%(username)s LIMIT 2", {"id": userId, "username": username}, True, True, (userId, username))
+            idAvailable = None if userId == None else not any(x[0] == userId for x in rows)
+            usernameAvailable = None if username == None else not any(x[1] == username for x in rows)
+            CredentialManager.__rememberAvailability(userId, username, idAvailable, usernameAvailable)
+            return (idAvailable, usernameAvailable)
         except:
             jutils.Utilities.logTracebackToFile("errors.log")
-            return False
+            return (False if userId != None else None, False if username != None else None)
+
+    def __rememberAvailability(userId, username, idAvailable, usernameAvailable):
+        cache = CredentialManager.availabilityCache
+        if cache != None:
+            if userId != None:
+                cache.put(("id", userId), idAvailable)
+            if username != None:
+                cache.put(("username", username), usernameAvailable)
+
+    def __forgetAvailability(user):
+        CredentialManager.__forgetAvailableKeys([user.getUniqueID()], [user.getUsername()])
+
+    def __forgetAvailableKeys(userIds, usernames):
+        cache = CredentialManager.availabilityCache
+        if cache != None:
+            for userId in userIds:
+                cache.pop(("id", userId))
+            for username in usernames:
+                cache.pop(("username", username))
+
+    # Used for every new password hash. Stored hashes made with older settings (or legacy unsalted SHA256) still verify,
+    # and are upgraded the next time their user logs in through verifyCredentials().
+    passwordHasher = jutils.PasswordHasher()
+
+    # Results of verifyCredentials().
+    VERIFIED = "verified"
+    INVALID = "invalid"
+    LOCKED = "locked"
+
+    # Successful verifications are remembered for a few seconds so a burst of logins for the same user only queries once.
+    # Entries hold an HMAC of the username and password under a key that only lives in this process, never the password itself,
+    # and are dropped as soon as the user is written to. Set 'verificationCache' to None to always ask the database.
+    verificationCache = jutils.LRUCache(maxEntries = 50000, ttl = 5000)
+    __verificationKey = os.urandom(32)
+    __writeGeneration = 0
+    # Checked against when a username doesn't exist, so unknown users take as long to reject as known ones.
+    __dummyHash = None
+
+    def __getDummyHash():
+        hasher = CredentialManager.passwordHasher
+        if CredentialManager.__dummyHash == None or hasher.needsRehash(CredentialManager.__dummyHash):
+            CredentialManager.__dummyHash = hasher.hash(os.urandom(16).hex())
+        return CredentialManager.__dummyHash
+
+    def verifyCredentials(username, password):
+        digest = hmac.new(CredentialManager.__verificationKey, f"{username}\0{password}".encode(encoding="UTF-8"), "sha256").digest()
+        cache = CredentialManager.verificationCache
+        cached = cache.get(username) if cache != None else None
+        if cached != None and hmac.compare_digest(cached, digest):
+            return CredentialManager.VERIFIED
 
-    def isUsernameAvailable(username):
-        CredentialManager.refreshConnection()
         try:
-            global cursor
-            cursor.execute("SELECT * FROM `Credential_Table` WHERE username=%(username)s LIMIT 1", {"username": username})
-            return len(cursor.fetchall()) == 0
+            dummyHash = CredentialManager.__getDummyHash()
+            generation = CredentialManager.__writeGeneration
+            # Always asks the primary, a lagging replica could still let a locked user or an old password in.
+            rows = CredentialManager.execute("SELECT pwhash,locked FROM `Credential_Table` WHERE username=%(username)s LIMIT 1", {"username": username}, True)
+            # Every attempt hashes the password once, whether the user exists or not, and locked users are only reported
+            # after their password checks out, so neither the response time nor the result reveals which usernames exist.
+            if len(rows) == 0:
+                CredentialManager.passwordHasher.verify(password, dummyHash)
+                return CredentialManager.INVALID
+            if not CredentialManager.passwordHasher.verify(password, rows[0][0]):
+                return CredentialManager.INVALID
+            if rows[0][1]:
+                return CredentialManager.LOCKED
+            if CredentialManager.passwordHasher.needsRehash(rows[0][0]):
+                CredentialManager.rehashPassword(username, password, rows[0][0])
+            # Skipped if the user may have been written to while we were asking, so a stale result is never cached.
+            if cache != None and generation == CredentialManager.__writeGeneration:
+                cache.put(username, digest)
+            return CredentialManager.VERIFIED
         except:
             jutils.Utilities.logTracebackToFile("errors.log")
-            return False
+            return CredentialManager.FAILED
+
+    # Upgrades a user's stored hash to the current algorithm and cost once we know their password. Only replaces 'oldHash',
+    # so a password reset that lands in between is never overwritten.
+    def rehashPassword(username, password, oldHash):
+        try:
+            CredentialManager.execute("UPDATE `Credential_Table` SET pwhash = %(pwhash)s WHERE username = %(username)s AND pwhash = %(oldHash)s", {"pwhash": CredentialManager.passwordHasher.hash(password), "username": username, "oldHash": oldHash}, True)
+            user = CredentialManager.__cache.getByName(username)
+            if user != None:
+                CredentialManager.uncacheUser(user)
+        except:
+            jutils.Utilities.logTracebackToFile("errors.log")
+
+    def isIdAvailable(userId):
+        return CredentialManager.checkAvailability(userId = userId)[0]
+
+    def isUsernameAvailable(username):
+        return CredentialManager.checkAvailability(username = username)[1]
 
     def deleteById(userId):
-        user = getUserById(userId)
+        user = CredentialManager.getUserById(userId)
         if user != None:
             CredentialManager.deleteUser(user)
 
     def deleteByUsername(username):
-        user = getUserByName(username)
+        user = CredentialManager.getUserByName(username)
         if user != None:
             CredentialManager.deleteUser(user)
     
     def getUserById(userId, useCache = True):
-        if useCache and (userId in CredentialManager.__cache.keys()):
-            return CredentialManager.__cache[userId]
-        
-        CredentialManager.refreshConnection()
+        if useCache:
+            user = CredentialManager.__cache.getById(userId)
+            if user != None:
+                return user
         
         try:
-            global cursor
-            cursor.execute("SELECT * FROM `Credential_Table` WHERE id=%(id)s LIMIT 1", {"id": userId})
-            return resultsToUser(cursor.fetchall()[0])
+            return CredentialManager.resultsToUser(CredentialManager.execute(f"SELECT {CredentialManager.userSelectColumns} FROM `Credential_Table` WHERE id=%(id)s LIMIT 1", {"id": userId}, True, True, (userId,))[0])
         except:
             jutils.Utilities.logTracebackToFile("errors.log")
             return None
 
     def getUserByName(username, useCache = True):
         if useCache:
-            for user in CredentialManager.__cache.values():
-                if user.getUsername() == username:
-                    return user
+            user = CredentialManager.__cache.getByName(username)
+            if user != None:
+                return user
 
-        CredentialManager.refreshConnection()
-        
         try:
-            global cursor
-            cursor.execute("SELECT * FROM `Credential_Table` WHERE username=%(username)s LIMIT 1", {"username": username})
-            return CredentialManager.resultsToUser(cursor.fetchall()[0])
+            return CredentialManager.resultsToUser(CredentialManager.execute(f"SELECT {CredentialManager.userSelectColumns} FROM `Credential_Table` WHERE username=%(username)s LIMIT 1", {"username": username}, True, True, (username,))[0])
         except:
             jutils.Utilities.logTracebackToFile("errors.log")
             return None
 
+    # Batch lookups return a dictionary of key -> User. Cached users are used where possible and the rest are fetched
+    # with 'WHERE ... IN (...)' queries of up to 'chunkSize' keys each. Keys that don't exist are left out of the result.
+    lookupChunkSize = 500
+
+    def getUsersByIds(userIds, useCache = True, chunkSize = None):
+        return CredentialManager.__getUsersBy("id", userIds, CredentialManager.__cache.getById if useCache else None, chunkSize, lambda x: x.getUniqueID())
+
+    def getUsersByNames(usernames, useCache = True, chunkSize = None):
+        return CredentialManager.__getUsersBy("username", usernames, CredentialManager.__cache.getByName if useCache else None, chunkSize, lambda x: x.getUsername())
+
+    def __getUsersBy(column, keys, cacheLookup, chunkSize, getKey):
+        chunkSize = CredentialManager.lookupChunkSize if chunkSize == None else max(1, chunkSize)
+        users = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            user = cacheLookup(key) if cacheLookup != None else None
+            if user != None:
+                users[key] = user
+            else:
+                missing.append(key)
+
+        try:
+            for start in range(0, len(missing), chunkSize):
+                params = {f"key{x}": missing[start + x] for x in range(0, min(chunkSize, len(missing) - start))}
+                for row in CredentialManager.execute(f"SELECT {CredentialManager.userSelectColumns} FROM `Credential_Table` WHERE {column} IN (" + ",".join(f"%({x})s" for x in params.keys()) + ")", params, read = True, keys = params.values()):
+                    user = CredentialManager.resultsToUser(row)
+                    users[getKey(user)] = user
+        except:
+            jutils.Utilities.logTracebackToFile("errors.log")
+        return users
+
     def resultsToUser(results):
-        user = User(results[0], results[1], results[3], results[4], results[5], results[6])
-        CredentialManager.__cache.update({user.getUniqueID(): user})
+        user = User(results[0], results[1], results[2], results[3], results[4], results[5])
+        CredentialManager.cacheUser(user)
         return user
 
+    def cacheUser(user):
+        CredentialManager.__cache.put(user)
+
+    def uncacheUser(user):
+        CredentialManager.__cache.remove(user)
+
+    # Only the modified columns are written. 'updatePassword' forces the password hash to be written if one is set.
     def updateUser(user, updatePassword = False):
-        CredentialManager.refreshConnection()
+        fields = user.getModifiedFields()
+        if updatePassword:
+            fields.add("pwhash")
+        if user.getPasswordHash() == None:
+            fields.discard("pwhash")
+        if len(fields) == 0:
+            return
+
         try:
-            global cursor
-            global connection
+            data = user.getDictionaryData(True)
+            CredentialManager.execute("UPDATE `Credential_Table` SET " + ", ".join(f"{x} = %({x})s" for x in sorted(fields)) + " WHERE id = %(id)s", data, True)
+            CredentialManager.rememberWrite(user)
+            user.clearModifiedFields()
+            user.setPasswordHash(None)
+        except:
+            jutils.Utilities.logTracebackToFile("errors.log")
+            print("An error occurred when saving the record.")
 
-            if updatePassword and user.getPasswordHash() != None:
-                cursor.execute("UPDATE `Credential_Table` SET pwhash = %(pwhash)s, nickname = %(nickname)s, role = %(role)s, creation = %(creation)s, locked = %(locked)s WHERE id = %(id)s", user.getDictionaryData(True))
-                user.setPasswordHash(None)
-            else:
-                cursor.execute("UPDATE `Credential_Table` SET nickname = %(nickname)s, role = %(role)s, creation = %(creation)s, locked = %(locked)s WHERE id = %(id)s", user.getDictionaryData(False))
+    # Writes every modified cached user back in a single transaction, 'batchSize' users per UPDATE statement.
+    # Each statement uses CASE expressions so a whole batch is a single round trip, and untouched columns are left alone.
+    flushBatchSize = 500
+
+    def flush(batchSize = None):
+        batchSize = CredentialManager.flushBatchSize if batchSize == None else batchSize
+        users = jutils.AdvancedMap(CredentialManager.__cache.values(), lazy = True).filterResults(lambda x: x.isDirty()).getResults()
+        if len(users) == 0:
+            return 0
 
-            connection.commit()
+        try:
+            with CredentialManager.transaction() as cursor:
+                for start in range(0, len(users), batchSize):
+                    statement, params = CredentialManager.__buildBatchUpdate(users[start:start + batchSize])
+                    cursor.execute(statement, params)
         except:
             jutils.Utilities.logTracebackToFile("errors.log")
-            print("An error occurred when saving the record.")
+            print("An error occurred when saving cached user data.")
+            return 0
+
+        CredentialManager.rememberWrite(*users)
+        for user in users:
+            user.clearModifiedFields()
+            user.setPasswordHash(None)
+        return len(users)
+
+    def __buildBatchUpdate(users):
+        params = {}
+        columns = {}
+        for index in range(0, len(users)):
+            data = users[index].getDictionaryData(True)
+            params[f"id{index}"] = data["id"]
+            for field in users[index].getModifiedFields():
+                if field != "pwhash" or data["pwhash"] != None:
+                    params[f"{field}{index}"] = data[field]
+                    columns.setdefault(field, []).append(index)
+
+        assignments = []
+        for field in sorted(columns.keys()):
+            cases = " ".join(f"WHEN %(id{x})s THEN %({field}{x})s" for x in columns[field])
+            assignments.append(f"{field} = CASE id {cases} ELSE {field} END")
+        ids = ",".join(f"%(id{x})s" for x in range(0, len(users)))
+        return (f"UPDATE `Credential_Table` SET {', '.join(assignments)} WHERE id IN ({ids})", params)
 
     def deleteUser(user):
-        CredentialManager.refreshConnection()
         try:
-            global cursor
-            global connection
-
-            cursor.execute("DELETE FROM `Credential_Table` WHERE id = %(id)s", {"id": user.getUniqueID()})
-            connection.commit()
-            CredentialManager.__cache.pop(user.getUniqueID())
+            CredentialManager.execute("DELETE FROM `Credential_Table` WHERE id = %(id)s", {"id": user.getUniqueID()}, True)
+            CredentialManager.rememberWrite(user)
+            CredentialManager.uncacheUser(user)
+            CredentialManager.__forgetAvailability(user)
         except:
             jutils.Utilities.logTracebackToFile("errors.log")
             print("An error occurred while deleting the user's data.")
 
     def getUserInfoList():
-        CredentialManager.refreshConnection()
         try:
-            global cursor
-            global connection
-
-            cursor.execute("SELECT id,username FROM `Credential_Table`")
-
-            return cursor.fetchall()
+            return list(CredentialManager.iterateUserInfo())
         except:
             jutils.Utilities.logTracebackToFile("errors.log")
-            print("An error occurred while deleting the user's data.")
+            print("An error occurred while retrieving the user list.")
+            return []
+
+    # Yields (id, username) pairs ordered by ID, fetching 'pageSize' rows per query with keyset pagination ('WHERE id > last ID'),
+    # so memory use stays flat and rows arrive as soon as the first page is read. 'prefix' filters usernames on the server.
+    userlistPageSize = 500
+
+    def iterateUserInfo(pageSize = None, after = None, prefix = None, limit = None):
+        pageSize = CredentialManager.userlistPageSize if pageSize == None else max(1, pageSize)
+        conditions = []
+        params = {}
+        if prefix != None and len(prefix) > 0:
+            conditions.append("username LIKE %(prefix)s ESCAPE '!'")
+            params["prefix"] = prefix.replace("!", "!!").replace("%", "!%").replace("_", "!_") + "%"
+
+        count = 0
+        while limit == None or count < limit:
+            params["limit"] = pageSize if limit == None else min(pageSize, limit - count)
+            if after != None:
+                params["after"] = after
+            where = " AND ".join(conditions + (["id > %(after)s"] if after != None else []))
+            rows = CredentialManager.execute("SELECT id,username FROM `Credential_Table`" + (f" WHERE {where}" if len(where) > 0 else "") + " ORDER BY id LIMIT %(limit)s", params, True, True)
+            for row in rows:
+                yield row
+            count += len(rows)
+            if len(rows) < params["limit"]:
+                break
+            after = rows[-1][0]
+
+    # === Bulk updates === #
+    bulkColumns = ["nickname", "role", "locked"]
+    bulkChunkSize = 500
+
+    # Returns the usernames matching a role and/or username prefix, in ID order.
+    def findUsernames(role = None, prefix = None):
+        conditions = []
+        params = {}
+        if role != None:
+            conditions.append("role = %(role)s")
+            params["role"] = role
+        if prefix != None and len(prefix) > 0:
+            conditions.append("username LIKE %(prefix)s ESCAPE '!'")
+            params["prefix"] = prefix.replace("!", "!!").replace("%", "!%").replace("_", "!_") + "%"
+        return [x[0] for x in CredentialManager.execute("SELECT username FROM `Credential_Table`" + (" WHERE " + " AND ".join(conditions) if len(conditions) > 0 else "") + " ORDER BY id", params, read = True)]
+
+    # Sets the columns in 'values' (any of 'bulkColumns') for every user in 'usernames' with one UPDATE per chunk of 'chunkSize' users,
+    # each in its own transaction. When 'role' is given it is checked again by the UPDATE, so users whose role changed in the meantime are left alone.
+    # Chunks run on several pooled connections at once if the backend allows it. Cached users are updated in place.
+    # Returns totals including how long each chunk took in milliseconds. 'progress' is called with the running totals after each chunk.
+    def bulkUpdate(values, usernames, role = None, chunkSize = None, progress = None):
+        if len(values) == 0 or any(x not in CredentialManager.bulkColumns for x in values.keys()):
+            raise ValueError(f"Only {', '.join(CredentialManager.bulkColumns)} can be updated in bulk.")
+
+        def update(cursor, chunk):
+            params = {f"username{x}": chunk[x] for x in range(0, len(chunk))}
+            params.update({f"set{x}": values[x] for x in values.keys()})
+            if role != None:
+                params["role"] = role
+            cursor.execute("UPDATE `Credential_Table` SET " + ", ".join(f"{x} = %(set{x})s" for x in sorted(values.keys())) + " WHERE username IN (" + ",".join(f"%({x})s" for x in params.keys() if x.startswith("username")) + ")" + (" AND role = %(role)s" if role != None else ""), params)
+            return cursor.rowcount
+
+        return CredentialManager.__updateInChunks(usernames, update, values, role, chunkSize, progress)
+
+    # Sets the password of every user in 'passwords' (a dictionary of username to password) and locks their account, as 'resetpw' does.
+    # The passwords are hashed together with hashMany, so they are spread over every core, and each chunk is written with one UPDATE.
+    # Takes the same 'chunkSize' and 'progress' as bulkUpdate and returns the same totals.
+    def resetPasswords(passwords, chunkSize = None, progress = None):
+        hashes = dict(zip(passwords.keys(), CredentialManager.passwordHasher.hashMany(passwords.values())))
+
+        def update(cursor, chunk):
+            params = {f"username{x}": chunk[x] for x in range(0, len(chunk))}
+            params.update({f"pwhash{x}": hashes[chunk[x]] for x in range(0, len(chunk))})
+            params["locked"] = True
+            names = ",".join(f"%(username{x})s" for x in range(0, len(chunk)))
+            cases = " ".join(f"WHEN %(username{x})s THEN %(pwhash{x})s" for x in range(0, len(chunk)))
+            cursor.execute(f"UPDATE `Credential_Table` SET pwhash = CASE username {cases} ELSE pwhash END, locked = %(locked)s WHERE username IN ({names})", params)
+            return cursor.rowcount
+
+        return CredentialManager.__updateInChunks(list(hashes.keys()), update, {"locked": True}, None, chunkSize, progress)
+
+    # Runs 'update(cursor, chunk)' for every chunk of 'usernames' in its own transaction, then applies 'values' to the cached users.
+    def __updateInChunks(usernames, update, values, role, chunkSize, progress):
+        global backend
+        global pool
+        chunkSize = CredentialManager.bulkChunkSize if chunkSize == None else max(1, chunkSize)
+        usernames = list(dict.fromkeys(usernames))
+        chunks = [usernames[x:x + chunkSize] for x in range(0, len(usernames), chunkSize)]
+        totals = {"users": len(usernames), "updated": 0, "failed": 0, "chunks": [], "elapsed": 0.0, "rate": 0.0}
+        lock = threading.Lock()
+        start = time.perf_counter()
+
+        def runChunk(chunk):
+            chunkStart = time.perf_counter()
+            updated = 0
+            failed = False
+            try:
+                with CredentialManager.transaction() as cursor:
+                    updated = update(cursor, chunk)
+                CredentialManager.rememberWrittenKeys([], chunk)
+                for username in chunk:
+                    user = CredentialManager.__cache.getByName(username)
+                    if user != None and (role == None or user.getRole() == role):
+                        user.applySavedFields(values)
+            except:
+                jutils.Utilities.logTracebackToFile("errors.log")
+                failed = True
+            with lock:
+                if failed:
+                    totals["failed"] += len(chunk)
+                else:
+                    totals["updated"] += updated
+                totals["chunks"].append(round((time.perf_counter() - chunkStart) * 1000, 3))
+                elapsed = time.perf_counter() - start
+                totals["elapsed"] = round(elapsed, 3)
+                totals["rate"] = round(totals["updated"] / elapsed, 1) if elapsed > 0 else 0.0
+                if progress != None:
+                    progress(dict(totals))
+
+        workers = min(pool.maxSize, len(chunks)) if backend.parallelWrites else 1
+        if workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+                list(executor.map(jutils.instrumentation.propagate(runChunk), chunks))
+        else:
+            for chunk in chunks:
+                runChunk(chunk)
+        return totals
+
+    # === Bulk import and export === #
+    userColumns = ["id", "username", "pwhash", "nickname", "role", "creation", "locked"]
+    importChunkSize = 1000
+
+    # Imports user records (dictionaries keyed by column name, with 'password' accepted in place of 'pwhash') in chunks.
+    # Each chunk is checked for duplicates with one query and inserted with one multi-row INSERT inside its own transaction.
+    # 'progress' is called after each chunk with the running totals.
+    def importUsers(records, chunkSize = None, progress = None):
+        chunkSize = CredentialManager.importChunkSize if chunkSize == None else chunkSize
+        totals = {"imported": 0, "duplicates": 0, "invalid": 0, "failed": 0, "elapsed": 0.0, "rate": 0.0}
+        seenIds = set()
+        seenNames = set()
+        start = time.perf_counter()
+        records = iter(records)
+
+        while True:
+            chunk = list(itertools.islice(records, chunkSize))
+            if len(chunk) == 0:
+                break
+
+            rows = []
+            for record in chunk:
+                row = CredentialManager.__recordToRow(record)
+                if row == None:
+                    totals["invalid"] += 1
+                elif row["id"] in seenIds or row["username"] in seenNames:
+                    totals["duplicates"] += 1
+                else:
+                    seenIds.add(row["id"])
+                    seenNames.add(row["username"])
+                    rows.append(row)
+
+            # Plain passwords are hashed together so a large chunk is spread over every core.
+            unhashed = [x for x in rows if x["pwhash"] == None and x["password"] != None]
+            for row, pwHash in zip(unhashed, CredentialManager.passwordHasher.hashMany([x["password"] for x in unhashed])):
+                row["pwhash"] = pwHash
+            for row in rows:
+                del row["password"]
+
+            try:
+                if len(rows) > 0:
+                    with CredentialManager.transaction() as cursor:
+                        ids = {f"id{x}": rows[x]["id"] for x in range(0, len(rows))}
+                        names = {f"username{x}": rows[x]["username"] for x in range(0, len(rows))}
+                        cursor.execute("SELECT id,username FROM `Credential_Table` WHERE id IN (" + ",".join(f"%({x})s" for x in ids.keys()) + ") OR username IN (" + ",".join(f"%({x})s" for x in names.keys()) + ")", {**ids, **names})
+                        existing = cursor.fetchall()
+                        takenIds = set(x[0] for x in existing)
+                        takenNames = set(x[1] for x in existing)
+                        newRows = [x for x in rows if not (x["id"] in takenIds or x["username"] in takenNames)]
+                        totals["duplicates"] += len(rows) - len(newRows)
+
+                        if len(newRows) > 0:
+                            statement, params = CredentialManager.__buildMultiRowInsert(newRows)
+                            cursor.execute(statement, params)
+                    CredentialManager.rememberWrittenKeys([x["id"] for x in newRows], [x["username"] for x in newRows])
+                    # Dropped rather than cached as taken, so a large import doesn't push every other entry out of the cache.
+                    CredentialManager.__forgetAvailableKeys([x["id"] for x in newRows], [x["username"] for x in newRows])
+                    totals["imported"] += len(newRows)
+            except:
+                jutils.Utilities.logTracebackToFile("errors.log")
+                totals["failed"] += len(rows)
+
+            totals["elapsed"] = round(time.perf_counter() - start, 3)
+            totals["rate"] = round(totals["imported"] / totals["elapsed"], 1) if totals["elapsed"] > 0 else 0.0
+            if progress != None:
+                progress(dict(totals))
+        return totals
+
+    def __recordToRow(record):
+        row = {"id": record.get("id", ""), "username": record.get("username", "")}
+        if not (isCredential(row["id"], False, False, 16) and isCredential(row["username"], False, False, 16)):
+            return None
+        row["pwhash"] = record.get("pwhash", None) or None
+        row["password"] = record.get("password", None) or None
+        row["nickname"] = record.get("nickname", None) or None
+        row["role"] = record.get("role", None) or None
+        row["creation"] = jutils.Utilities.tryParse(record.get("creation", None), jutils.Utilities.getSystemTime())
+        row["locked"] = str(record.get("locked", "")).lower() in ("1", "true", "yes", "y")
+        return row
+
+    def __buildMultiRowInsert(rows):
+        params = {}
+        values = []
+        for index in range(0, len(rows)):
+            values.append("(" + ",".join(f"%({x}{index})s" for x in CredentialManager.userColumns) + ")")
+            params.update({f"{x}{index}": rows[index][x] for x in CredentialManager.userColumns})
+        return ("INSERT INTO `Credential_Table` (" + ",".join(CredentialManager.userColumns) + ") VALUES " + ",".join(values), params)
+
+    # Yields every user as a dictionary. Rows are streamed from an unbuffered cursor 'chunkSize' at a time instead of being fetched all at once.
+    def exportUsers(chunkSize = None):
+        global backend
+        global pool
+        chunkSize = CredentialManager.importChunkSize if chunkSize == None else chunkSize
+        pooled = pool.acquire()
+        finished = False
+        try:
+            cursor = BackendCursor(pooled.connection.cursor(), backend)
+            cursor.execute("SELECT " + ",".join(CredentialManager.userColumns) + " FROM `Credential_Table`")
+            while True:
+                rows = cursor.fetchmany(chunkSize)
+                if len(rows) == 0:
+                    break
+                for row in rows:
+                    yield dict(zip(CredentialManager.userColumns, row))
+            cursor.close()
+            finished = True
+        finally:
+            # A partially read result leaves the connection unusable, so it is discarded if the export was cut short.
+            pool.release(pooled, not finished)
+
+class AsyncCredentialManager():
+    # Exposes the CredentialManager operations as coroutines for use inside an asyncio event loop.
+    # Database work runs on a thread pool no larger than the connection pool, so the loop is never blocked and we never queue more work than there are connections.
+    # Concurrent lookups for the same key share one query, and cache hits are answered without leaving the loop.
+    def __init__(self, workers = None):
+        global pool
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers if workers != None else (pool.maxSize if pool != None else 8), thread_name_prefix = "CredentialManager")
+        self.__inFlight = {}
+        self.__stats = {"queries": 0, "coalesced": 0, "cacheHits": 0}
+
+    async def __run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.__executor, functools.partial(function, *args))
+
+    async def __coalesce(self, key, function, *args):
+        future = self.__inFlight.get(key, None)
+        if future == None:
+            self.__stats["queries"] += 1
+            future = asyncio.ensure_future(self.__run(function, *args))
+            self.__inFlight[key] = future
+            future.add_done_callback(lambda x: self.__inFlight.pop(key, None))
+        else:
+            self.__stats["coalesced"] += 1
+        # Shielded so one caller being cancelled doesn't cancel the query for everyone else waiting on it.
+        return await asyncio.shield(future)
+
+    async def getUserById(self, userId, useCache = True):
+        user = CredentialManager.getCache().getById(userId) if useCache else None
+        if user != None:
+            self.__stats["cacheHits"] += 1
+            return user
+        return await self.__coalesce(("id", userId, useCache), CredentialManager.getUserById, userId, useCache)
+
+    async def getUserByName(self, username, useCache = True):
+        user = CredentialManager.getCache().getByName(username) if useCache else None
+        if user != None:
+            self.__stats["cacheHits"] += 1
+            return user
+        return await self.__coalesce(("username", username, useCache), CredentialManager.getUserByName, username, useCache)
+
+    async def getUsersByIds(self, userIds, useCache = True):
+        return await self.__run(CredentialManager.getUsersByIds, userIds, useCache)
+
+    async def getUsersByNames(self, usernames, useCache = True):
+        return await self.__run(CredentialManager.getUsersByNames, usernames, useCache)
+
+    async def checkAvailability(self, userId = None, username = None):
+        return await self.__coalesce(("availability", userId, username), CredentialManager.checkAvailability, userId, username)
+
+    async def verifyCredentials(self, username, password):
+        return await self.__run(CredentialManager.verifyCredentials, username, password)
+
+    async def createUser(self, user):
+        return await self.__run(CredentialManager.createUser, user)
+
+    async def updateUser(self, user, updatePassword = False):
+        return await self.__run(CredentialManager.updateUser, user, updatePassword)
+
+    async def deleteUser(self, user):
+        return await self.__run(CredentialManager.deleteUser, user)
+
+    async def getUserInfoList(self):
+        return await self.__run(CredentialManager.getUserInfoList)
+
+    # An async generator over (id, username) pairs. Each page is fetched on the thread pool, so rows are yielded without blocking the loop.
+    async def iterateUserInfo(self, pageSize = None, after = None, prefix = None, limit = None):
+        pageSize = CredentialManager.userlistPageSize if pageSize == None else max(1, pageSize)
+        rows = CredentialManager.iterateUserInfo(pageSize, after, prefix, limit)
+        while True:
+            page = await self.__run(lambda: list(itertools.islice(rows, pageSize)))
+            for row in page:
+                yield row
+            if len(page) < pageSize:
+                break
+
+    def getStats(self):
+        return dict(self.__stats, inFlight = len(self.__inFlight))
+
+    def close(self):
+        self.__executor.shutdown(wait = True)
 
 class User():
     def __init__(self, userId, username, nickname, role, creationDate, isLocked):
@@ -261,6 +1518,7 @@ class User():
         self.role = role
         self.creationDate = creationDate
         self.locked = isLocked
+        self.__modified = set()
 
     def getUniqueID(self):
         return self.userId
@@ -273,12 +1531,14 @@ class User():
 
     def setNickname(self, nickname):
         self.nickname = nickname
+        self.__modified.add("nickname")
 
     def getRole(self):
         return self.role
 
     def setRole(self, role):
         self.role = role
+        self.__modified.add("role")
 
     def getCreationDate(self):
         return self.creationDate
@@ -288,19 +1548,67 @@ class User():
 
     def setLocked(self, locked):
         self.locked = locked
+        self.__modified.add("locked")
 
     def setPasswordHash(self, pwHash):
         self.__pwHash = pwHash
+        if pwHash != None:
+            self.__modified.add("pwhash")
+        else:
+            self.__modified.discard("pwhash")
+
+    # The columns that have been modified since the user was loaded or last saved.
+    def getModifiedFields(self):
+        return set(self.__modified)
+
+    def isDirty(self):
+        return len(self.__modified) > 0
+
+    def clearModifiedFields(self):
+        self.__modified.clear()
 
     def getPasswordHash(self):
         return self.__pwHash
 
+    # Applies column values that were already written to the database by someone else, so they aren't written again.
+    def applySavedFields(self, values):
+        for field in values.keys():
+            setattr(self, field, values[field])
+            self.__modified.discard(field)
+
     def getDictionaryData(self, fullData = False):
         if fullData:
             return {"id": self.userId, "username": self.username, "pwhash": self.__pwHash, "nickname": self.nickname, "role": self.role, "creation": self.creationDate, "locked": self.locked}
         else:
             return {"id": self.userId, "username": self.username, "nickname": self.nickname, "role": self.role, "creation": self.creationDate, "locked": self.locked}         
 
+def readUserRecords(filename):
+    # Streams user records from a '.csv' file (with a header row) or a '.jsonl' file (one JSON object per line).
+    with open(filename, "r", newline = "") as fileRead:
+        if filename.lower().endswith(".csv"):
+            for record in csv.DictReader(fileRead):
+                yield record
+        else:
+            for line in fileRead:
+                if len(line.strip()) > 0:
+                    yield json.loads(line)
+
+def writeUserRecords(filename, records):
+    # Writes user records to a '.csv' or '.jsonl' file as they arrive and returns how many were written.
+    count = 0
+    with open(filename, "w", newline = "") as fileWrite:
+        writer = None
+        if filename.lower().endswith(".csv"):
+            writer = csv.DictWriter(fileWrite, fieldnames = CredentialManager.userColumns)
+            writer.writeheader()
+        for record in records:
+            if writer != None:
+                writer.writerow(record)
+            else:
+                fileWrite.write(json.dumps(record) + "\n")
+            count += 1
+    return count
+
 def getCredential(msg, header = "", ignoreAlphanumeric = False, acceptNone = False, maxSize = -1, clearAfter = True, clearFirst = True):
     if clearFirst:
         clearScreen()
@@ -348,7 +1656,7 @@ def clearScreen(msg = None):
 
 def awaitConfirmation(question = "Is this ok? Y/N"):
     print(question)
-    return msvcrt.getwch().lower() == "y"
+    return (msvcrt.getwch() if msvcrt != None else input()[:1]).lower() == "y"
 
 def createUser():
     userId = ""
@@ -359,30 +1667,23 @@ def createUser():
     locked = False
 
     clearScreen()
-    
-    while True:
-        userId = getCredential("Enter a unique user ID for your new user (16 characters max): ", "CredentialManager [5.0.0-alpha]\nRyan Jones @ 2018\n", maxSize = 16)
-
-        clearScreen("Checking availability...\n")
-
-        if CredentialManager.isIdAvailable(userId):
-            print("ID available.\n")
-            break
-        else:
-            print("This user ID is in use!\n")
 
-    while True:
-        username = getCredential("Enter a unique username for your new user (16 characters max): ", "CredentialManager [5.0.0-alpha]\nRyan Jones @ 2018\n", maxSize = 16)
+    # Both keys are checked with one query; only the ones that are taken need to be entered again.
+    idAvailable = False
+    usernameAvailable = False
+    while not (idAvailable and usernameAvailable):
+        if not idAvailable:
+            userId = getCredential("Enter a unique user ID for your new user (16 characters max): ", "CredentialManager [5.0.0-alpha]\nRyan Jones @ 2018\n", maxSize = 16)
+        if not usernameAvailable:
+            username = getCredential("Enter a unique username for your new user (16 characters max): ", "CredentialManager [5.0.0-alpha]\nRyan Jones @ 2018\n", maxSize = 16)
 
         clearScreen("Checking availability...\n")
 
-        if CredentialManager.isIdAvailable(username):
-            print("Username available.\n")
-            break
-        else:
-            print("This username is in use!\n")
+        idAvailable, usernameAvailable = CredentialManager.checkAvailability(userId, username)
+        print("ID available.\n" if idAvailable else "This user ID is in use!\n")
+        print("Username available.\n" if usernameAvailable else "This username is in use!\n")
 
-    pwHash = jutils.Utilities.convertStringToHash(getCredential("Enter a password for your new user (16 characters max): ", "CredentialManager [5.0.0-alpha]\nRyan Jones @ 2018\n", ignoreAlphanumeric = True, maxSize = 16))
+    pwHash = CredentialManager.passwordHasher.hash(getCredential("Enter a password for your new user (16 characters max): ", "CredentialManager [5.0.0-alpha]\nRyan Jones @ 2018\n", ignoreAlphanumeric = True, maxSize = 16))
 
     nickname = getCredential("(Optional) Enter a nickname for your new user (16 characters max): ", "CredentialManager [5.0.0-alpha]\nRyan Jones @ 2018\n", ignoreAlphanumeric = True, acceptNone = True, maxSize = 16)
     role = getCredential("(Optional) Enter a role for your new user (16 characters max): ", "CredentialManager [5.0.0-alpha]\nRyan Jones @ 2018\n", ignoreAlphanumeric = True, acceptNone = True, maxSize = 16)
@@ -393,12 +1694,17 @@ def createUser():
         print("Saving to database...\n")
         user = User(userId, username, nickname, role, jutils.Utilities.getSystemTime(), locked)
         user.setPasswordHash(pwHash)
-        CredentialManager.createUser(user)
-        print("Operation complete!\n")
+        result = CredentialManager.createUser(user)
+        if result == CredentialManager.CREATED:
+            print("Operation complete!\n")
+        elif result == CredentialManager.FAILED:
+            print("The user could not be saved.\n")
+        else:
+            print(("This user ID" if result == CredentialManager.ID_TAKEN else "This username") + " was taken by someone else in the meantime. The user was not saved.\n")
 
 def isConnected():
-    global connection
-    return connection != None and connection.is_connected()
+    global pool
+    return pool != None and not pool.isClosed()
 
 # === Commands Section === #
 class ExitCommand():
@@ -426,6 +1732,9 @@ class ExitCommand():
     def getDisabledReason(self):
         return "You must be logged out to use this command."
 
+    def isInteractive(self, args):
+        return True
+
 class LoginCommand():
     def getName(self):
         return "login"
@@ -455,6 +1764,9 @@ class LoginCommand():
     def getDisabledReason(self):
         return "You cannot log into another server whilest being connected to another!"
 
+    def isInteractive(self, args):
+        return True
+
 class ConnectedCommand():
     def isEnabled(self):
         return isConnected()
@@ -467,23 +1779,126 @@ class UserlistCommand(ConnectedCommand):
         return "userlist"
 
     def execute(self, args):
+        options = {"--page": None, "--after": None, "--limit": None, "--prefix": None}
+        index = 0
+        while index < len(args):
+            if args[index].lower() in options.keys() and index + 1 < len(args):
+                options[args[index].lower()] = args[index + 1]
+                index += 2
+            else:
+                options["--prefix"] = args[index]
+                index += 1
+
         print("{:^17}|{:^17}".format("Unique ID", "Username"))
         print("-" * 35)
-        
-        for userdata in CredentialManager.getUserInfoList():
-            print(" {: <16}| {: <16}".format(userdata[0], userdata[1]))
+
+        count = 0
+        try:
+            for userdata in CredentialManager.iterateUserInfo(jutils.Utilities.tryParse(options["--page"], None), options["--after"], options["--prefix"], jutils.Utilities.tryParse(options["--limit"], None)):
+                print(" {: <16}| {: <16}".format(userdata[0], userdata[1]))
+                jutils.storedVariables.update({"userlist-last": userdata[0]})
+                count += 1
+        except:
+            jutils.Utilities.logTracebackToFile("errors.log")
+            print("An error occurred while retrieving the user list.")
+        jutils.storedVariables.update({"userlist-count": count})
 
     def getMinimumArguments(self):
         return 0
     
     def getUsage(self):
-        return "userlist"
+        return "userlist (prefix) (--prefix [prefix]) (--after [ID]) (--limit [count]) (--page [size])"
     
     def getShortDescription(self):
         return "Lists all users and their unique IDs."
     
     def getLongDescription(self):
-        return ["Lists all users and their unique IDs."]
+        return ["Lists all users and their unique IDs, ordered by ID.", "--prefix only lists usernames starting with the given prefix.", "--after starts listing after the given ID, --limit stops after that many users.", "--page sets how many users are fetched from the database at a time.", "The last ID listed is stored in 'userlist-last' so you can continue with --after."]
+
+class ConnectionStatsCommand(ConnectedCommand):
+    def getName(self):
+        return "dbstats"
+
+    def execute(self, args):
+        stats = CredentialManager.getConnectionStats()
+        print("\n===[Connection Pool Stats]===")
+        for key in stats.keys():
+            print("{: <18}{}".format(key + ":", stats[key]))
+        print()
+        jutils.storedVariables.update({"db-" + key: stats[key] for key in stats.keys()})
+
+    def getMinimumArguments(self):
+        return 0
+    
+    def getUsage(self):
+        return "dbstats"
+    
+    def getShortDescription(self):
+        return "Shows connection pool usage and how often connections were probed or replaced."
+    
+    def getLongDescription(self):
+        return ["Shows connection pool usage and how often connections were probed or replaced.", "Wait times are in milliseconds. Probes only happen once a connection has been idle for a while."]
+
+class ReplicasCommand(ConnectedCommand):
+    def getName(self):
+        return "replicas"
+
+    def execute(self, args):
+        global replicas
+        if len(args) > 0:
+            if args[0] not in ("round-robin", "least-latency"):
+                print(f"\n[ERROR] Unknown routing policy '{args[0]}', use 'round-robin' or 'least-latency'.\n")
+                return
+            ReplicaRouter.policy = args[0]
+        stats = CredentialManager.getReplicaStats()
+        if len(stats) == 0:
+            print("\nNo read replicas are configured, all reads go to the primary.\n")
+            return
+        print(f"\n===[Read Replicas ({ReplicaRouter.policy})]===")
+        print("{: <24}{: <10}{: <10}{: <14}{: <10}{}".format("Replica", "Healthy", "Reads", "Latency (ms)", "Failures", "Ejections"))
+        for replica in stats:
+            print("{: <24}{: <10}{: <10}{: <14}{: <10}{}".format(replica["replica"], "yes" if replica["healthy"] else "no", replica["reads"], replica["latency"], replica["failures"], replica["ejections"]))
+        print()
+        jutils.storedVariables.update({"replicas-healthy": len([x for x in stats if x["healthy"]]), "replicas-reads": sum(x["reads"] for x in stats)})
+
+    def getMinimumArguments(self):
+        return 0
+    
+    def getUsage(self):
+        return "replicas [round-robin|least-latency]"
+    
+    def getShortDescription(self):
+        return "Shows the health of each read replica and optionally changes how reads are spread across them."
+    
+    def getLongDescription(self):
+        return ["Shows the health of each read replica and optionally changes how reads are spread across them.", "Replicas that keep failing are ejected for a while and their reads go to the primary.", "Reads for users you changed this session always go to the primary so you see your own changes."]
+
+class CacheStatsCommand():
+    def getName(self):
+        return "cachestats"
+
+    def execute(self, args):
+        stats = CredentialManager.getCacheStats()
+        print("\n===[User Cache Stats]===")
+        for key in stats.keys():
+            print("{: <18}{}".format(key + ":", stats[key]))
+        print()
+        jutils.storedVariables.update({"cache-" + key: stats[key] for key in stats.keys()})
+
+    def getMinimumArguments(self):
+        return 0
+    
+    def getUsage(self):
+        return "cachestats"
+    
+    def getShortDescription(self):
+        return "Shows user cache hits, misses and evictions."
+    
+    def getLongDescription(self):
+        return ["Shows user cache hits, misses and evictions.", "Entries expire after a while and the least recently used users are evicted once the cache is full."]
+
+    def isEnabled(self):
+        return True
 
 class ResetPasswordCommand(ConnectedCommand):
     def getName(self):
@@ -497,7 +1912,7 @@ class ResetPasswordCommand(ConnectedCommand):
             print("\nThis user does not exist!\n")
             return
 
-        user.setPasswordHash(convertStringToHash(getCredential("Enter a new password for the user: (16 characters max): ", "CredentialManager [5.0.0-alpha]\nRyan Jones @ 2018\n", ignoreAlphanumeric = True, maxSize = 16)))
+        user.setPasswordHash(CredentialManager.passwordHasher.hash(getCredential("Enter a new password for the user: (16 characters max): ", "CredentialManager [5.0.0-alpha]\nRyan Jones @ 2018\n", ignoreAlphanumeric = True, maxSize = 16)))
         user.setLocked(True)
 
         CredentialManager.updateUser(user)
@@ -516,6 +1931,9 @@ class ResetPasswordCommand(ConnectedCommand):
     def getLongDescription(self):
         return ["Resets a user's password and locks their account."]
 
+    def isInteractive(self, args):
+        return True
+
 class SetRoleCommand(ConnectedCommand):
     def getName(self):
         return "setrole"
@@ -546,6 +1964,9 @@ class SetRoleCommand(ConnectedCommand):
     def getLongDescription(self):
         return ["Sets a user's role."]
 
+    def isInteractive(self, args):
+        return True
+
 class SetNickCommand(ConnectedCommand):
     def getName(self):
         return "setnick"
@@ -576,6 +1997,39 @@ class SetNickCommand(ConnectedCommand):
     def getLongDescription(self):
         return ["Sets a user's nickname."]
 
+    def isInteractive(self, args):
+        return True
+
+class PrefetchCommand(ConnectedCommand):
+    def getName(self):
+        return "prefetch"
+
+    def execute(self, args):
+        usernames = list(args)
+        if args[0].lower() == "--file":
+            try:
+                with open(args[1] if len(args) > 1 else "", "r") as fileRead:
+                    usernames = jutils.AdvancedMap(fileRead, lazy = True).mapResults(lambda x: x.strip()).filterResults(lambda x: len(x) > 0).getResults()
+            except IOError:
+                print("\nThe file does not exist!\n")
+                return
+
+        users = CredentialManager.getUsersByNames(usernames)
+        jutils.storedVariables.update({"prefetched": len(users)})
+        print(f"\n{len(users)} of {len(set(usernames))} user(s) were loaded.\n")
+
+    def getMinimumArguments(self):
+        return 1
+    
+    def getUsage(self):
+        return "prefetch [usernames...] or prefetch --file [file]"
+    
+    def getShortDescription(self):
+        return "Loads many users into the cache at once."
+    
+    def getLongDescription(self):
+        return ["Loads many users into the cache at once.", "Scripts that work on lots of users can prefetch them first,", "so later commands don't query the database one user at a time.", "With --file, the file should list one username per line."]
+
 class DetailUserCommand(ConnectedCommand):
     def getName(self):
         return "detailuser"
@@ -645,6 +2099,9 @@ class LockUserCommand(ConnectedCommand):
     def getLongDescription(self):
         return ["Allows you to set whether or not a user is locked.", "Y locks the account, N unlocks it."]
 
+    def isInteractive(self, args):
+        return True
+
 class DeleteUserCommand(ConnectedCommand):
     def getName(self):
         return "deleteuser"
@@ -675,6 +2132,9 @@ class DeleteUserCommand(ConnectedCommand):
     def getLongDescription(self):
         return ["Deletes a user from the given username.", "Nothing happens if the username does not exist."]
 
+    def isInteractive(self, args):
+        return True
+
 class LogoutCommand(ConnectedCommand):
     def getName(self):
         return "logout"
@@ -696,6 +2156,306 @@ class LogoutCommand(ConnectedCommand):
     def getLongDescription(self):
         return ["Properly saves user data, logs out, and exits gracefully.", "You should always use this command upon completion of your tasks."]
 
+class ImportUsersCommand(ConnectedCommand):
+    def getName(self):
+        return "importusers"
+
+    def execute(self, args):
+        try:
+            progress = lambda x: print("Imported {imported} users ({duplicates} duplicates, {invalid} invalid, {failed} failed) - {rate} users/s".format(**x))
+            totals = CredentialManager.importUsers(readUserRecords(args[0]), jutils.Utilities.tryParse(args[1], None) if len(args) > 1 else None, progress)
+            jutils.storedVariables.update({"imported": totals["imported"]})
+            print(f"\nImport complete in {totals['elapsed']}s.\n")
+        except IOError:
+            print("\nThe file does not exist!\n")
+        except:
+            jutils.Utilities.logTracebackToFile("errors.log")
+            print("\nAn error occurred while reading the file.\n")
+
+    def getMinimumArguments(self):
+        return 1
+    
+    def getUsage(self):
+        return "importusers [file] (chunk size)"
+    
+    def getShortDescription(self):
+        return "Imports users from a '.csv' or '.jsonl' file."
+    
+    def getLongDescription(self):
+        return ["Imports users from a '.csv' or '.jsonl' file.", "Records use the columns id, username, password (or pwhash), nickname, role, creation and locked.", "Users whose ID or username is already taken are skipped."]
+
+class ExportUsersCommand(ConnectedCommand):
+    def getName(self):
+        return "exportusers"
+
+    def execute(self, args):
+        try:
+            start = time.perf_counter()
+            count = writeUserRecords(args[0], CredentialManager.exportUsers(jutils.Utilities.tryParse(args[1], None) if len(args) > 1 else None))
+            elapsed = time.perf_counter() - start
+            jutils.storedVariables.update({"exported": count})
+            print(f"\nExported {count} users in {round(elapsed, 3)}s ({round(count / elapsed if elapsed > 0 else 0, 1)} users/s).\n")
+        except IOError:
+            print("\nThe file could not be written!\n")
+        except:
+            jutils.Utilities.logTracebackToFile("errors.log")
+            print("\nAn error occurred while exporting users.\n")
+
+    def getMinimumArguments(self):
+        return 1
+    
+    def getUsage(self):
+        return "exportusers [file] (chunk size)"
+    
+    def getShortDescription(self):
+        return "Exports all users to a '.csv' or '.jsonl' file."
+    
+    def getLongDescription(self):
+        return ["Exports all users to a '.csv' or '.jsonl' file.", "The export includes password hashes, so keep the file safe."]
+
+class BulkUpdateCommand(ConnectedCommand):
+    # Shared by the bulk commands. The first argument is the new value, followed by the users to change:
+    # a file with one username per line (--file), or everyone matching --role and/or --prefix. --yes skips the confirmation.
+    # By default the new value is text of at most 16 characters for 'column', subclasses for other kinds of values override getValues and describe.
+    column = None
+
+    def getValues(self, value):
+        if not isCredential(value, True, False, 16):
+            print(f"\n[ERROR] The {self.column} can be at most 16 characters.\n")
+            return None
+        return {self.column: value}
+
+    def describe(self, value):
+        return f"Set the {self.column} to '{value}'"
+
+    def execute(self, args):
+        options = {"--file": None, "--role": None, "--prefix": None, "--chunk": None}
+        confirmed = False
+        index = 1
+        while index < len(args):
+            if args[index].lower() == "--yes":
+                confirmed = True
+                index += 1
+            elif args[index].lower() in options.keys() and index + 1 < len(args):
+                options[args[index].lower()] = args[index + 1]
+                index += 2
+            else:
+                print(f"\n[ERROR] Unknown option '{args[index]}'.\n")
+                return
+
+        values = self.getValues(args[0])
+        if values == None:
+            return
+
+        try:
+            if options["--file"] != None:
+                with open(options["--file"], "r") as fileRead:
+                    usernames = jutils.AdvancedMap(fileRead, lazy = True).mapResults(lambda x: x.strip()).filterResults(lambda x: len(x) > 0).getResults()
+            elif options["--role"] != None or options["--prefix"] != None:
+                usernames = CredentialManager.findUsernames(options["--role"], options["--prefix"])
+            else:
+                print("\nChoose the users to change with --file, --role or --prefix.\n")
+                return
+        except IOError:
+            print("\nThe file does not exist!\n")
+            return
+        except:
+            jutils.Utilities.logTracebackToFile("errors.log")
+            print("\nAn error occurred while finding the users.\n")
+            return
+
+        if len(usernames) == 0:
+            print("\nNo users matched.\n")
+            return
+        if not confirmed and not awaitConfirmation(f"\n{self.describe(args[0])} for {len(usernames)} user(s)? Y to continue, N to cancel."):
+            return
+
+        totals = CredentialManager.bulkUpdate(values, usernames, options["--role"], jutils.Utilities.tryParse(options["--chunk"], None), lambda x: print("Updated {updated} of {users} users ({failed} failed) - {rate} users/s".format(**x)))
+        chunks = totals["chunks"]
+        jutils.storedVariables.update({"bulk-updated": totals["updated"], "bulk-failed": totals["failed"]})
+        print(f"\nUpdated {totals['updated']} user(s) in {totals['elapsed']}s ({totals['rate']} users/s).")
+        print(f"{len(chunks)} chunk(s): {min(chunks)}ms min, {round(sum(chunks) / len(chunks), 3)}ms average, {max(chunks)}ms max.\n")
+
+    def getMinimumArguments(self):
+        return 2
+
+    def isInteractive(self, args):
+        return "--yes" not in [x.lower() for x in args[1:]]
+
+class BulkLockCommand(BulkUpdateCommand):
+    def getName(self):
+        return "bulklock"
+
+    def getValues(self, value):
+        if value.lower() not in ("lock", "unlock"):
+            print("\n[ERROR] Use 'lock' or 'unlock'.\n")
+            return None
+        return {"locked": value.lower() == "lock"}
+
+    def describe(self, value):
+        return "Lock accounts" if value.lower() == "lock" else "Unlock accounts"
+
+    def getUsage(self):
+        return "bulklock [lock|unlock] (--file [file]) (--role [role]) (--prefix [prefix]) (--chunk [size]) (--yes)"
+    
+    def getShortDescription(self):
+        return "Locks or unlocks many users at once."
+    
+    def getLongDescription(self):
+        return ["Locks or unlocks many users at once.", "--file reads one username per line, --role and --prefix select matching users from the database.", "Users are updated --chunk at a time (500 by default), over several connections when the database allows it.", "--yes skips the confirmation."]
+
+class BulkRoleCommand(BulkUpdateCommand):
+    column = "role"
+
+    def getName(self):
+        return "bulkrole"
+
+    def getUsage(self):
+        return "bulkrole [role] (--file [file]) (--role [role]) (--prefix [prefix]) (--chunk [size]) (--yes)"
+    
+    def getShortDescription(self):
+        return "Sets the role of many users at once."
+    
+    def getLongDescription(self):
+        return ["Sets the role of many users at once.", "--file reads one username per line, --role and --prefix select matching users from the database.", "Users are updated --chunk at a time (500 by default), over several connections when the database allows it.", "--yes skips the confirmation."]
+
+class BulkNickCommand(BulkUpdateCommand):
+    column = "nickname"
+
+    def getName(self):
+        return "bulknick"
+
+    def getUsage(self):
+        return "bulknick [nickname] (--file [file]) (--role [role]) (--prefix [prefix]) (--chunk [size]) (--yes)"
+    
+    def getShortDescription(self):
+        return "Sets the nickname of many users at once."
+    
+    def getLongDescription(self):
+        return ["Sets the nickname of many users at once.", "--file reads one username per line, --role and --prefix select matching users from the database.", "Users are updated --chunk at a time (500 by default), over several connections when the database allows it.", "--yes skips the confirmation."]
+
+class BulkPasswordCommand(ConnectedCommand):
+    def getName(self):
+        return "bulkpw"
+
+    def execute(self, args):
+        options = {"--chunk": None}
+        confirmed = False
+        index = 1
+        while index < len(args):
+            if args[index].lower() == "--yes":
+                confirmed = True
+                index += 1
+            elif args[index].lower() in options.keys() and index + 1 < len(args):
+                options[args[index].lower()] = args[index + 1]
+                index += 2
+            else:
+                print(f"\n[ERROR] Unknown option '{args[index]}'.\n")
+                return
+
+        try:
+            passwords = {x.get("username", ""): x.get("password", "") for x in readUserRecords(args[0])}
+        except IOError:
+            print("\nThe file does not exist!\n")
+            return
+        except:
+            jutils.Utilities.logTracebackToFile("errors.log")
+            print("\nAn error occurred while reading the file.\n")
+            return
+
+        invalid = [x for x, y in passwords.items() if not (isCredential(x, False, False, 16) and isCredential(y or "", True, False, 16))]
+        if len(invalid) > 0:
+            print(f"\n[ERROR] {len(invalid)} record(s) need a username and a password of at most 16 characters, starting with '{invalid[0]}'.\n")
+            return
+        if len(passwords) == 0:
+            print("\nThe file has no users.\n")
+            return
+        if not confirmed and not awaitConfirmation(f"\nReset the passwords of {len(passwords)} user(s) and lock their accounts? Y to continue, N to cancel."):
+            return
+
+        totals = CredentialManager.resetPasswords(passwords, jutils.Utilities.tryParse(options["--chunk"], None), lambda x: print("Reset {updated} of {users} passwords ({failed} failed) - {rate} users/s".format(**x)))
+        jutils.storedVariables.update({"bulk-updated": totals["updated"], "bulk-failed": totals["failed"]})
+        print(f"\nReset {totals['updated']} password(s) in {totals['elapsed']}s ({totals['rate']} users/s).\n")
+
+    def getMinimumArguments(self):
+        return 1
+    
+    def getUsage(self):
+        return "bulkpw [file] (--chunk [size]) (--yes)"
+    
+    def getShortDescription(self):
+        return "Resets the passwords of many users at once and locks their accounts."
+    
+    def getLongDescription(self):
+        return ["Resets the passwords of many users at once and locks their accounts, like 'resetpw'.", "The file is a '.csv' or '.jsonl' file of records with a username and a password.", "Passwords are hashed over every core and users are updated --chunk at a time (500 by default).", "--yes skips the confirmation."]
+
+    def isInteractive(self, args):
+        return "--yes" not in [x.lower() for x in args[1:]]
+
+class FindUsersCommand(ConnectedCommand):
+    # Stores the matching usernames as a list variable, so scripts can walk them with 'foreach'.
+    def getName(self):
+        return "findusers"
+
+    def execute(self, args):
+        options = {"--role": None, "--prefix": None, "--limit": None}
+        variable = "users"
+        index = 0
+        while index < len(args):
+            if args[index].lower() in options.keys() and index + 1 < len(args):
+                options[args[index].lower()] = args[index + 1]
+                index += 2
+            elif index == 0 and not args[index].startswith("--"):
+                variable = args[index]
+                index += 1
+            else:
+                print(f"\n[ERROR] Unknown option '{args[index]}'.\n")
+                return
+        try:
+            usernames = CredentialManager.findUsernames(options["--role"], options["--prefix"])
+        except:
+            jutils.Utilities.logTracebackToFile("errors.log")
+            print("\nAn error occurred while finding the users.\n")
+            return
+        limit = jutils.Utilities.tryParse(options["--limit"], None)
+        if limit != None:
+            usernames = usernames[:max(0, limit)]
+        jutils.storedVariables.update({variable: usernames, "results": len(usernames)})
+        print(f"\n{len(usernames)} user(s) were stored in '{variable}'.\n")
+
+    def getMinimumArguments(self):
+        return 0
+    
+    def getUsage(self):
+        return "findusers (variable) (--role [role]) (--prefix [prefix]) (--limit [count])"
+    
+    def getShortDescription(self):
+        return "Stores the usernames matching a query in a variable."
+    
+    def getLongDescription(self):
+        return ["Stores the usernames matching a query in a list variable ('users' by default).", "--role and --prefix select matching users, --limit keeps only the first users by id.", "The number of users found is stored in the results variable.", "Scripts can loop over the users with 'foreach [variable] in [list variable]'."]
+
+class FlushCommand(ConnectedCommand):
+    def getName(self):
+        return "flush"
+
+    def execute(self, args):
+        saved = CredentialManager.flush(jutils.Utilities.tryParse(args[0], None) if len(args) > 0 else None)
+        jutils.storedVariables.update({"flushed": saved})
+        print(f"\n{saved} modified user(s) were saved.\n")
+
+    def getMinimumArguments(self):
+        return 0
+    
+    def getUsage(self):
+        return "flush (batch size)"
+    
+    def getShortDescription(self):
+        return "Saves all modified cached users to the database."
+    
+    def getLongDescription(self):
+        return ["Saves all modified cached users to the database.", "Users are written in batches inside a single transaction.", "Users that were only viewed are not written."]
+
 class CreateUserCommand(ConnectedCommand):
     def getName(self):
         return "createuser"
@@ -714,7 +2474,10 @@ class CreateUserCommand(ConnectedCommand):
     
     def getLongDescription(self):
         return ["Starts a prompt to create a new user.", "The prompt is relatively secure, as the screen is cleared", "as each credential is entered."]
-    
+
+    def isInteractive(self, args):
+        return True
+
 class ClearCommand():
     def getName(self):
         return "clear"
@@ -738,10 +2501,15 @@ class ClearCommand():
         return True
 
 # === Main Section === #
+# Operations timed by the 'stats' command. Every statement sent to the database counts as one round trip.
+jutils.instrumentation.register(CredentialManager, ["execute", "getUserById", "getUserByName", "getUsersByIds", "getUsersByNames", "checkAvailability", "verifyCredentials", "createUser", "updateUser", "deleteUser", "flush", "bulkUpdate", "importUsers", "getUserInfoList"], "credentials")
+jutils.instrumentation.register(PreparedStatement, ["execute"], "db", "db.roundTrips").register(BackendCursor, ["execute", "executemany"], "db", "db.roundTrips")
+jutils.instrumentation.addGauges("cache", CredentialManager.getCacheStats).addGauges("pool", CredentialManager.getConnectionStats)
+
 if __name__ == "__main__":
     if "idlelib" in sys.modules:
         print("\n===[Compatibility Error]===\nThis program is only compatible when run through Windows terminal.\n")
         sys.exit()
     
     jutils.storedVariables.update({"logged-in": "false"})
-    jutils.runTerminal("CredentialManager [5.0.0-alpha]\nRyan Jones @ 2018\n\nUse the 'help' command for details on how to use commands.\n", [ClearCommand(), CreateUserCommand(), DeleteUserCommand(), LockUserCommand(), SetRoleCommand(), SetNickCommand(), ResetPasswordCommand(), UserlistCommand(), DetailUserCommand(), ExitCommand(), LoginCommand(), LogoutCommand()])
+    jutils.runTerminal("CredentialManager [5.0.0-alpha]\nRyan Jones @ 2018\n\nUse the 'help' command for details on how to use commands.\n", [ClearCommand(), CreateUserCommand(), DeleteUserCommand(), LockUserCommand(), SetRoleCommand(), SetNickCommand(), ResetPasswordCommand(), UserlistCommand(), DetailUserCommand(), ConnectionStatsCommand(), ReplicasCommand(), CacheStatsCommand(), ExitCommand(), LoginCommand(), LogoutCommand(), FlushCommand(), ImportUsersCommand(), ExportUsersCommand(), PrefetchCommand(), BulkLockCommand(), BulkRoleCommand(), BulkNickCommand(), BulkPasswordCommand(), FindUsersCommand()])
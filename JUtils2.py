@@ -7,8 +7,20 @@ import time
 import traceback
 import shlex
 import sys
+import threading
+import collections
+import itertools
+import concurrent.futures
+import hmac
+import os
+import json
+import atexit
+import functools
+import math
 
 storedVariables = {}
+loggers = {}
+loggerLock = threading.Lock()
 
 class Compatibility():
     """Provides simple methods to aid with compatibility."""
@@ -30,91 +42,112 @@ class Compatibility():
         return Compatibility.getVersion()[0]
 
 class AdvancedMap():
-    """Provides a simple methods to map and filter objects without having to nest and cast excessively."""
-    def __init__(self, *results):
-        self.results = []
-        for x in results:
-            if hasattr(x, "__iter__"):
-                self.results += list(x)
-            else:
-                self.results.append(x)
+    """Provides a simple methods to map and filter objects without having to nest and cast excessively.\nWith 'lazy' set, maps, filters and forEach calls are chained into one generator pipeline instead of building a list at each step.\nThe pipeline runs once, when the results are first needed, and additions are chained onto the end of it without copying."""
+    def __init__(self, *results, lazy = False):
+        self.lazy = lazy
+        if lazy:
+            self.results = itertools.chain.from_iterable(x if hasattr(x, "__iter__") else (x,) for x in results)
+        elif len(results) == 1 and hasattr(results[0], "__iter__"):
+            self.results = list(results[0])
+        else:
+            self.results = []
+            for x in results:
+                if hasattr(x, "__iter__"):
+                    self.results.extend(x)
+                else:
+                    self.results.append(x)
 
     def __iter__(self):
-        for x in self.results:
-            yield x
+        return iter(self.__evaluate())
 
     def __getitem__(self, key):
-        return self.results[key]
+        return self.__evaluate()[key]
 
     def __bool__(self):
-        return len(self.results) > 0
+        return len(self.__evaluate()) > 0
 
     def __len__(self):
-        return len(self.results)
+        return len(self.__evaluate())
 
     def __add__(self, other):
-        if hasattr(other, "__iter__"):
-            self.results = self.results + list(other)
+        if other is self:
+            other = list(self.__evaluate())
+        if self.lazy:
+            self.results = itertools.chain(self.results, other if hasattr(other, "__iter__") else (other,))
+        elif hasattr(other, "__iter__"):
+            self.results.extend(other)
         else:
             self.results.append(other)
         return self
 
     def __iadd__(self, other):
-        if hasattr(other, "__iter__"):
-            self.results = self.results + list(other)
-        else:
-            self.results.append(other)
-        return self
+        return self.__add__(other)
 
     def __repr__(self):
-        return "AdvancedMap(%s)" % self.results
-        
+        return "AdvancedMap(%s)" % self.__evaluate()
+
+    def __evaluate(self):
+        # Runs a lazy pipeline and keeps its results, so it is only ever run once.
+        if type(self.results) is not list:
+            self.results = list(self.results)
+        return self.results
+
     def mapData(self, function, data):
-        """Does the same thing as map(), but it casts `data` to a list, the results are stored as a list to be editted or retrieved with other functions.\n'function' - Either a lambda function or a pre-defined function to be used for mapping.\n'data' - Some iterable data structure that can be cast to a list."""
-        self.results = list(map(function, list(data)))
+        """Does the same thing as map(), but the results are stored as a list to be editted or retrieved with other functions.\n'function' - Either a lambda function or a pre-defined function to be used for mapping.\n'data' - Some iterable data structure that can be cast to a list."""
+        self.results = map(function, data) if self.lazy else list(map(function, data))
         return self
     
     def mapResults(self, function):
         """Does the same thing as map(), but re-maps the stored results with function given.\n'function' - Either a lambda function or a pre-defined function to be used for mapping."""
-        return self.mapData(function, self)
+        return self.mapData(function, self.results)
 
     def selectivelyMapResults(self, filterFunction, mapFunction):
         """Using 'filterFunction', only the elements filtered for true will be remapped with 'mapFunction'."""
-        plist = Utilities.createEmbeddedList(range(0, len(self)), self)
-        AdvancedMap(plist).filterResults(lambda x: filterFunction(x[1])).forEach(lambda x: AdvancedMap.__setElementAt(self.results, x[0], mapFunction(x[1])))
+        if self.lazy:
+            self.results = map(lambda x: mapFunction(x) if filterFunction(x) else x, self.results)
+            return self
+        for index, x in enumerate(self.results):
+            if filterFunction(x):
+                self.results[index] = mapFunction(x)
         return self
 
-    def __setElementAt(plist, index, newElement):
-        # Internal function so we can do an assignment operator in a lambda, normally not allowed.
-        plist[index] = newElement
-
     def addMapToResults(self, function, data):
         """Maps the data provided using the function, and then adds it to the stored results.\n'function' - Either a lambda function or a pre-defined function to be used for mapping.\n'data' - Some iterable data structure that can be cast to a list."""
-        self.results += list(map(function, list(data)))
-        return self
+        return self.__add__(map(function, data))
     
     def filterResults(self, function):
         """Filters stored results using the function provided, and thus alters the final result.\n'function' - The function used to filter the stored results."""
-        self.results = self.getFilteredResults(function)
+        self.results = filter(function, self.results) if self.lazy else self.getFilteredResults(function)
         return self
 
     def forEach(self, function):
-        """Executes the given function and passes each stored result as a parameter."""
-        for x in self:
+        """Executes the given function and passes each stored result as a parameter. Lazy maps call it as each result passes through the pipeline."""
+        if self.lazy:
+            self.results = AdvancedMap.__passThrough(function, self.results)
+            return self
+        for x in self.results:
             function(x)
         return self
 
+    def __passThrough(function, results):
+        for x in results:
+            function(x)
+            yield x
+
     def getResults(self):
         """Returns the results of all maps and filters."""
-        return self.results
+        return self.__evaluate()
     
     def getFilteredResults(self, function):
         """Returns the results of all maps and filters, and filters them. Stored results are not affected.\n'function' - Lambda expression or function to filter the data with."""
-        return list(filter(function, self.results))
+        return list(filter(function, self.__evaluate()))
 
     def clearResults(self):
         """Clears stored results."""
-        self.results.clear()
+        if type(self.results) is list:
+            self.results.clear()
+        else:
+            self.results = []
         return self
 
 class Utilities():
@@ -126,6 +159,36 @@ class Utilities():
         except:
             return otherwise
 
+    def compareValues(left, operator, right):
+        """Compares two values with one of >, >=, =, <, <= or !=. Values that both parse to integers are compared as numbers, otherwise as strings."""
+        if type(left) is int or type(right) is int or (Utilities.tryParse(left, None) != None and Utilities.tryParse(right, None) != None):
+            left, right = Utilities.tryParse(left, None), Utilities.tryParse(right, None)
+            if left == None or right == None:
+                return False
+        else:
+            left, right = str(left), str(right)
+        if operator == ">":
+            return left > right
+        if operator == ">=":
+            return left >= right
+        if operator == "=":
+            return left == right
+        if operator == "<":
+            return left < right
+        if operator == "<=":
+            return left <= right
+        if operator == "!=":
+            return left != right
+        return False
+
+    def toList(value):
+        """Returns value as a list. Strings are split on commas and None gives an empty list."""
+        if value == None:
+            return []
+        if isinstance(value, (list, tuple, AdvancedMap)):
+            return list(value)
+        return [x.strip() for x in str(value).split(",") if len(x.strip()) > 0]
+
     def replaceAll(string, values):
         """Parses string to replace all values (%value%) with their corresponding dictionary value."""
         for x in values.keys():
@@ -133,14 +196,59 @@ class Utilities():
                 string = string.replace(f"%{x}%", str(values[x]))
         return string
 
+    templateCacheSize = 10000
+    __templates = {}
+
+    def compileTemplate(string):
+        """Returns a tuple of the positions of every '%' in a string and the name between each one and the next.\nTemplates are cached, so arguments that are used again (such as script lines run in a loop) are only scanned once."""
+        template = Utilities.__templates.get(string, None)
+        if template == None:
+            positions = tuple(x for x in range(0, len(string)) if string[x] == "%")
+            template = (positions, tuple(string[positions[x] + 1:positions[x + 1]] for x in range(0, len(positions) - 1)))
+            if len(Utilities.__templates) >= Utilities.templateCacheSize:
+                Utilities.__templates.clear()
+            Utilities.__templates[string] = template
+        return template
+
+    def substitute(string, values):
+        """Replaces each %name% in 'string' with its value from the 'values' dictionary in a single pass, looking each name up once.\nUnknown names are left as they are, and their closing '%' may still open the next name."""
+        if "%" not in string:
+            return string
+        positions, names = Utilities.compileTemplate(string)
+        result = []
+        last = 0
+        index = 0
+        while index < len(names):
+            value = values.get(names[index], None)
+            if value == None:
+                index += 1
+                continue
+            result.append(string[last:positions[index]])
+            result.append(str(value))
+            last = positions[index + 1] + 1
+            index += 2
+        if last == 0:
+            return string
+        result.append(string[last:])
+        return "".join(result)
+
     def convertStringToHash(string):
-        """Returns a SHA256 hash from a string."""
+        """Returns an unsalted SHA256 hash from a string. Kept to verify old hashes, use PasswordHasher for new ones."""
         return sha.sha256(string.encode(encoding="UTF-16")).hexdigest()
     
     def logTracebackToFile(filename):
-        """Logs the most recent traceback to a file named 'filename'."""
-        with open(filename, "a") as fileWrite:
-            fileWrite.write(Utilities.getSystemTimeString() + "\n" + traceback.format_exc())
+        """Logs the most recent traceback to a file named 'filename'. The write happens in the background, see BufferedLogger."""
+        Utilities.getLogger(filename).logTraceback()
+
+    def getLogger(filename):
+        """Returns the BufferedLogger for 'filename', creating it the first time. Every logger is flushed and closed when the program exits."""
+        with loggerLock:
+            logger = loggers.get(filename, None)
+            if logger == None:
+                logger = BufferedLogger(filename)
+                loggers[filename] = logger
+                atexit.register(logger.close)
+            return logger
 
     def getSystemTime():
         """Returns the system time in milliseconds."""
@@ -156,7 +264,7 @@ class Utilities():
     
     def stringToIntList(string):
         """Converts a string to an integer list. The elements correspond to the character code in the original string."""
-        return AdvancedMapMap().mapData(lambda x: ord(x), string).getResults()
+        return AdvancedMap().mapData(lambda x: ord(x), string).getResults()
 
     def intListToString(intList):
         """Converts an integer list into a string."""
@@ -203,43 +311,735 @@ class Utilities():
         """Creates a dictionary given keys and values."""
         return dict(map(lambda x, y: (x, y), keys, values))
 
+class BufferedLogger():
+    """Writes structured log records (one JSON object per line) from a background thread, so logging never waits on the disk.\nRecords are held in a ring buffer until the writer flushes them in batches, identical tracebacks are only written once\nper 'dedupeWindow' and the file is rotated once it grows past 'maxBytes'."""
+    def __init__(self, filename, capacity = 10000, flushInterval = 1000, maxBytes = 10485760, backups = 3, dedupeWindow = 10000):
+        """'filename' - The file records are appended to.\n'capacity' - The most records buffered at once, the oldest are dropped when it is full.\n'flushInterval' - How often in milliseconds the writer flushes the buffer.\n'maxBytes' - The size at which the file is rotated, 0 to never rotate.\n'backups' - How many rotated files ('filename.1', 'filename.2', ...) are kept.\n'dedupeWindow' - How long in milliseconds an identical traceback is suppressed after being logged."""
+        self.filename = filename
+        self.flushInterval = flushInterval
+        self.maxBytes = maxBytes
+        self.backups = backups
+        self.dedupeWindow = dedupeWindow
+        self.__buffer = collections.deque(maxlen = capacity)
+        self.__recent = {}
+        self.__lock = threading.Lock()
+        self.__writeLock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__closed = False
+        self.__writer = None
+        self.__stats = {"logged": 0, "written": 0, "dropped": 0, "suppressed": 0, "rotations": 0, "writeErrors": 0}
+
+    def log(self, level, message, **fields):
+        """Buffers a record with the given level, message and any extra fields. Returns immediately."""
+        record = {"time": Utilities.getSystemTime(), "timestamp": Utilities.getSystemTimeString(), "level": level, "message": message}
+        record.update(fields)
+        with self.__lock:
+            if len(self.__buffer) == self.__buffer.maxlen:
+                self.__stats["dropped"] += 1
+            self.__buffer.append(record)
+            self.__stats["logged"] += 1
+            # The writer is woken early once the buffer is three quarters full, rather than dropping records until the next interval.
+            if len(self.__buffer) * 4 >= self.__buffer.maxlen * 3:
+                self.__wake.set()
+            if self.__writer == None:
+                self.__writer = threading.Thread(target = self.__run, name = f"BufferedLogger({self.filename})", daemon = True)
+                self.__writer.start()
+
+    def logTraceback(self, message = "An exception occurred.", level = "error"):
+        """Buffers the most recent traceback. Repeats of the same traceback within 'dedupeWindow' are counted instead of logged,\nand the count is written with the next copy that gets through."""
+        trace = traceback.format_exc()
+        now = Utilities.getSystemTime()
+        with self.__lock:
+            recent = self.__recent.get(trace, None)
+            if recent != None and now - recent[0] < self.dedupeWindow:
+                recent[1] += 1
+                self.__stats["suppressed"] += 1
+                return
+            repeated = recent[1] if recent != None else 0
+            self.__recent[trace] = [now, 0]
+            if len(self.__recent) > 1000:
+                self.__recent = {x: y for x, y in self.__recent.items() if now - y[0] < self.dedupeWindow}
+        if repeated > 0:
+            self.log(level, message, traceback = trace, repeated = repeated)
+        else:
+            self.log(level, message, traceback = trace)
+
+    def flush(self):
+        """Writes every buffered record to the file now."""
+        with self.__writeLock:
+            with self.__lock:
+                records = list(self.__buffer)
+                self.__buffer.clear()
+            if len(records) == 0:
+                return
+            data = "".join(json.dumps(x, default = str) + "\n" for x in records)
+            try:
+                if self.maxBytes > 0 and os.path.exists(self.filename) and os.path.getsize(self.filename) + len(data) > self.maxBytes:
+                    self.__rotate()
+                with open(self.filename, "a") as fileWrite:
+                    fileWrite.write(data)
+                self.__count("written", len(records))
+            except OSError:
+                self.__count("writeErrors")
+
+    def __count(self, key, amount = 1):
+        with self.__lock:
+            self.__stats[key] += amount
+
+    def close(self):
+        """Writes every buffered record and stops the writer thread. Records logged afterwards are written by the next flush() call."""
+        self.__closed = True
+        self.__wake.set()
+        self.flush()
+
+    def __rotate(self):
+        if self.backups > 0:
+            for index in range(self.backups - 1, 0, -1):
+                if os.path.exists(f"{self.filename}.{index}"):
+                    os.replace(f"{self.filename}.{index}", f"{self.filename}.{index + 1}")
+            os.replace(self.filename, f"{self.filename}.1")
+        else:
+            os.remove(self.filename)
+        self.__count("rotations")
+
+    def __run(self):
+        while not self.__closed:
+            self.__wake.wait(self.flushInterval / 1000)
+            self.__wake.clear()
+            self.flush()
+
+    def getStats(self):
+        """Returns counts of records logged, written, dropped because the buffer was full and suppressed as duplicates."""
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["buffered"] = len(self.__buffer)
+            return stats
+
+class Histogram():
+    """Counts latencies in exponentially sized buckets, from 'minimum' milliseconds up, each 'growth' times wider than the last.\nPercentiles are read from the buckets, so they are accurate to within one bucket (about 19% with the defaults)."""
+    def __init__(self, minimum = 0.001, growth = 1.1892, buckets = 128):
+        self.minimum = minimum
+        self.growth = growth
+        self.__logGrowth = math.log(growth)
+        self.counts = [0] * buckets
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def record(self, elapsed, error = False):
+        """Adds a latency in milliseconds, and counts it as an error if 'error' is set."""
+        index = 0 if elapsed <= self.minimum else min(len(self.counts) - 1, int(math.log(elapsed / self.minimum) / self.__logGrowth) + 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.total += elapsed
+        self.maximum = max(self.maximum, elapsed)
+        if error:
+            self.errors += 1
+
+    def getPercentile(self, percentile):
+        """Returns the latency in milliseconds that 'percentile' (0 to 100) percent of recorded calls finished within."""
+        if self.count == 0:
+            return 0.0
+        target = self.count * percentile / 100
+        seen = 0
+        for index in range(0, len(self.counts)):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self.maximum, self.minimum * self.growth ** index)
+        return self.maximum
+
+class Instrumentation():
+    """Records call counts, error counts and latency histograms for named operations, plus plain counters and gauges.\nFunctions are registered once but only wrapped while instrumentation is enabled, so it costs nothing while it is off."""
+    def __init__(self):
+        self.enabled = False
+        self.__targets = []
+        self.__histograms = {}
+        self.__counters = {}
+        self.__gauges = {}
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def register(self, owner, names, prefix, counter = None):
+        """Registers the functions called 'names' on 'owner' (a class or module) to be timed as '<prefix>.<name>'.\nWith 'counter', each call only adds one to that counter instead of being timed."""
+        for name in names:
+            self.__targets.append((owner, name, owner.__dict__[name], f"{prefix}.{name}", counter))
+            if self.enabled:
+                setattr(owner, name, self.__wrap(self.__targets[-1]))
+        return self
+
+    def addGauges(self, prefix, function):
+        """Registers 'function', which returns a dictionary of numbers read as '<prefix>.<key>' gauges whenever stats are collected."""
+        self.__gauges[prefix] = function
+        return self
+
+    def enable(self):
+        """Wraps every registered function and starts recording."""
+        if not self.enabled:
+            self.enabled = True
+            for target in self.__targets:
+                setattr(target[0], target[1], self.__wrap(target))
+        return self
+
+    def disable(self):
+        """Puts every registered function back as it was and stops recording. Recorded stats are kept."""
+        if self.enabled:
+            self.enabled = False
+            for target in self.__targets:
+                setattr(target[0], target[1], target[2])
+        return self
+
+    def reset(self):
+        """Forgets everything recorded so far."""
+        with self.__lock:
+            self.__histograms.clear()
+            self.__counters.clear()
+        return self
+
+    def __wrap(self, target):
+        original = target[2]
+        name = target[3]
+        counter = target[4]
+        if counter != None:
+            @functools.wraps(original)
+            def counted(*args, **kwargs):
+                self.increment(counter)
+                return original(*args, **kwargs)
+            return counted
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                result = original(*args, **kwargs)
+            except:
+                self.record(name, (time.perf_counter() - start) * 1000, True)
+                raise
+            self.record(name, (time.perf_counter() - start) * 1000)
+            return result
+        return timed
+
+    def record(self, name, elapsed, error = False):
+        """Records one call to 'name' that took 'elapsed' milliseconds."""
+        with self.__lock:
+            histogram = self.__histograms.get(name, None)
+            if histogram == None:
+                histogram = Histogram()
+                self.__histograms[name] = histogram
+            histogram.record(elapsed, error)
+
+    def increment(self, name, amount = 1):
+        """Adds 'amount' to the counter 'name', and to the counts of the command running on this thread."""
+        scope = getattr(self.__local, "scope", None)
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+            if scope != None:
+                scope[name] = scope.get(name, 0) + amount
+
+    def getCounter(self, name):
+        """Returns the current value of the counter 'name'."""
+        return self.__counters.get(name, 0)
+
+    def executeCommand(self, command, args):
+        """Runs a command for CommandProcessor2 while timing it and counting the database round trips it made.\nOnly round trips made on this thread, or by functions passed through propagate(), are counted, so commands running at the same time on other threads don't add to them."""
+        name = f"command.{command.getName().lower()}"
+        outer = getattr(self.__local, "scope", None)
+        scope = {}
+        self.__local.scope = scope
+        start = time.perf_counter()
+        try:
+            command.execute(args)
+        except:
+            self.record(name, (time.perf_counter() - start) * 1000, True)
+            raise
+        finally:
+            self.__local.scope = outer
+            # Commands run by another command count towards both of them.
+            if outer != None:
+                with self.__lock:
+                    for key, value in scope.items():
+                        outer[key] = outer.get(key, 0) + value
+        self.record(name, (time.perf_counter() - start) * 1000)
+        self.increment(f"{name}.roundTrips", scope.get("db.roundTrips", 0))
+
+    def propagate(self, function):
+        """Returns 'function' wrapped so that the counters it increments, even from another thread, count towards the command running on this thread."""
+        scope = getattr(self.__local, "scope", None)
+        @functools.wraps(function)
+        def propagated(*args, **kwargs):
+            outer = getattr(self.__local, "scope", None)
+            self.__local.scope = scope
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.__local.scope = outer
+        return propagated
+
+    def getStats(self):
+        """Returns (timings, counters, gauges). Timings map each name to its count, errors, mean, p50, p95, p99 and max in milliseconds."""
+        with self.__lock:
+            timings = {x: {"count": y.count, "errors": y.errors, "mean": y.total / y.count, "p50": y.getPercentile(50), "p95": y.getPercentile(95), "p99": y.getPercentile(99), "max": y.maximum, "sum": y.total} for x, y in self.__histograms.items()}
+            counters = dict(self.__counters)
+        gauges = {}
+        for prefix, function in list(self.__gauges.items()):
+            try:
+                gauges.update({f"{prefix}.{x}": y for x, y in function().items() if type(y) in (int, float)})
+            except:
+                Utilities.logTracebackToFile("errors.log")
+        return (timings, counters, gauges)
+
+    def toPrometheus(self, namespace = "jutils"):
+        """Returns every timing, counter and gauge in the Prometheus text exposition format. Timings are exported as summaries in seconds."""
+        timings, counters, gauges = self.getStats()
+        metricName = lambda x: namespace + "_" + "".join(y if y.isalnum() else "_" for y in x)
+        lines = []
+        for name in sorted(timings.keys()):
+            metric = metricName(name) + "_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for quantile in ("p50", "p95", "p99"):
+                lines.append(f'{metric}{{quantile="0.{quantile[1:]}"}} {timings[name][quantile] / 1000}')
+            lines.append(f"{metric}_sum {timings[name]['sum'] / 1000}")
+            lines.append(f"{metric}_count {timings[name]['count']}")
+            lines.append(f"# TYPE {metricName(name)}_errors_total counter")
+            lines.append(f"{metricName(name)}_errors_total {timings[name]['errors']}")
+        for name in sorted(counters.keys()):
+            lines.append(f"# TYPE {metricName(name)}_total counter")
+            lines.append(f"{metricName(name)}_total {counters[name]}")
+        for name in sorted(gauges.keys()):
+            lines.append(f"# TYPE {metricName(name)} gauge")
+            lines.append(f"{metricName(name)} {float(gauges[name])}")
+        return "\n".join(lines) + "\n"
+
+instrumentation = Instrumentation()
+
+class LRUCache():
+    """A thread-safe least-recently-used cache with optional limits on entry count, total size and entry age."""
+    def __init__(self, maxEntries = 0, maxBytes = 0, ttl = 0, sizeOf = None, onEvict = None):
+        """'maxEntries' - The most entries held at once, 0 for no limit.\n'maxBytes' - The most bytes held at once (as measured by 'sizeOf'), 0 for no limit.\n'ttl' - How long in milliseconds an entry stays valid after being stored, 0 for forever.\n'sizeOf' - Function used to measure a value, defaults to sys.getsizeof.\n'onEvict' - Function called with (key, value) for each entry evicted by a limit or expiry."""
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.sizeOf = sizeOf if sizeOf != None else sys.getsizeof
+        self.onEvict = onEvict
+        self.__entries = collections.OrderedDict()
+        self.__bytes = 0
+        self.__lock = threading.RLock()
+        self.__stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key, default = None):
+        """Returns the value stored under 'key' and marks it as recently used, or 'default' if it is absent or expired."""
+        expired = None
+        with self.__lock:
+            entry = self.__entries.get(key, None)
+            if entry != None and self.ttl > 0 and entry[1] <= Utilities.getSystemTime():
+                expired = self.__remove(key)
+                self.__stats["expirations"] += 1
+                entry = None
+            if entry == None:
+                self.__stats["misses"] += 1
+            else:
+                self.__stats["hits"] += 1
+                self.__entries.move_to_end(key)
+        if expired != None:
+            self.__evicted([expired])
+            return default
+        return default if entry == None else entry[0]
+
+    def put(self, key, value):
+        """Stores 'value' under 'key', evicting the least recently used entries if a limit is exceeded."""
+        evicted = []
+        with self.__lock:
+            if key in self.__entries:
+                self.__remove(key)
+            size = self.sizeOf(value) if self.maxBytes > 0 else 0
+            self.__entries[key] = [value, Utilities.getSystemTime() + self.ttl, size]
+            self.__bytes += size
+            while len(self.__entries) > 1 and ((self.maxEntries > 0 and len(self.__entries) > self.maxEntries) or (self.maxBytes > 0 and self.__bytes > self.maxBytes)):
+                evicted.append(self.__remove(next(iter(self.__entries))))
+                self.__stats["evictions"] += 1
+        self.__evicted(evicted)
+        return self
+
+    def pop(self, key, default = None):
+        """Removes and returns the value stored under 'key' without calling 'onEvict'."""
+        with self.__lock:
+            return self.__remove(key)[1] if key in self.__entries else default
+
+    def __remove(self, key):
+        entry = self.__entries.pop(key)
+        self.__bytes -= entry[2]
+        return (key, entry[0])
+
+    def __evicted(self, evicted):
+        # Called outside of the lock, since eviction handlers may do slow work such as writing back to a database.
+        if self.onEvict != None:
+            for entry in evicted:
+                self.onEvict(entry[0], entry[1])
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def keys(self):
+        """Returns a list of the stored keys, least recently used first."""
+        with self.__lock:
+            return list(self.__entries.keys())
+
+    def values(self):
+        """Returns a list of the stored values, least recently used first."""
+        with self.__lock:
+            return [x[0] for x in self.__entries.values()]
+
+    def clear(self):
+        """Removes every entry without calling 'onEvict'."""
+        with self.__lock:
+            self.__entries.clear()
+            self.__bytes = 0
+        return self
+
+    def getStats(self):
+        """Returns a dictionary of hit, miss, eviction and expiration counts along with the current size of the cache."""
+        with self.__lock:
+            stats = dict(self.__stats)
+            lookups = stats["hits"] + stats["misses"]
+            stats.update({"entries": len(self.__entries), "bytes": self.__bytes, "hitRatio": round(stats["hits"] / lookups, 3) if lookups > 0 else 0.0})
+            return stats
+
+class PasswordHasher():
+    """Hashes passwords into self-describing strings like '$pbkdf2-sha256$600000$salt$hash' or '$scrypt$16384,8,1$salt$hash' (salt and hash in hex),\nso the algorithm and cost can be raised later without breaking stored hashes. Bare 64 character hex strings are recognised as\nlegacy hashes from Utilities.convertStringToHash."""
+    algorithms = ("pbkdf2-sha256", "scrypt")
+
+    def __init__(self, algorithm = "pbkdf2-sha256", iterations = 600000, n = 16384, r = 8, p = 1, workers = None):
+        """'algorithm' - Either 'pbkdf2-sha256' or 'scrypt'.\n'iterations' - The PBKDF2 work factor.\n'n', 'r', 'p' - The scrypt cost, block size and parallelism.\n'workers' - How many processes hashMany may use, defaults to one per core."""
+        if algorithm not in PasswordHasher.algorithms:
+            raise ValueError(f"Unknown password hashing algorithm '{algorithm}'.")
+        self.algorithm = algorithm
+        self.iterations = iterations
+        self.n = n
+        self.r = r
+        self.p = p
+        self.workers = workers
+        self.__executor = None
+        self.__lock = threading.Lock()
+
+    def __getstate__(self):
+        # Sent to worker processes by hashMany, which have no use for our executor or lock.
+        state = dict(self.__dict__)
+        state.pop("_PasswordHasher__executor")
+        state.pop("_PasswordHasher__lock")
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__executor = None
+        self.__lock = threading.Lock()
+
+    def getParameters(self):
+        """Returns the parameter field written into new hashes."""
+        return str(self.iterations) if self.algorithm == "pbkdf2-sha256" else f"{self.n},{self.r},{self.p}"
+
+    def hash(self, password):
+        """Returns a new salted hash of 'password' using the current algorithm and cost."""
+        salt = os.urandom(16)
+        return f"${self.algorithm}${self.getParameters()}${salt.hex()}${PasswordHasher.__derive(self.algorithm, self.getParameters(), password, salt).hex()}"
+
+    def verify(self, password, stored):
+        """Returns True if 'password' matches the hash 'stored', which may be in any supported or legacy format. Compares in constant time."""
+        if stored == None:
+            return False
+        if PasswordHasher.isLegacy(stored):
+            return hmac.compare_digest(stored.lower(), Utilities.convertStringToHash(password))
+        try:
+            algorithm, parameters, salt, expected = stored.split("$")[1:]
+            return hmac.compare_digest(PasswordHasher.__derive(algorithm, parameters, password, bytes.fromhex(salt)), bytes.fromhex(expected))
+        except ValueError:
+            return False
+
+    def needsRehash(self, stored):
+        """Returns True if 'stored' is a legacy hash or was made with a different algorithm or cost than this hasher's."""
+        return PasswordHasher.isLegacy(stored) or not stored.startswith(f"${self.algorithm}${self.getParameters()}$")
+
+    def isLegacy(stored):
+        """Returns True if 'stored' is an unsalted SHA256 hash from Utilities.convertStringToHash."""
+        return len(stored) == 64 and all(x in "0123456789abcdefABCDEF" for x in stored)
+
+    def hashMany(self, passwords, chunkSize = 16):
+        """Hashes every password in 'passwords' across a pool of worker processes and returns the hashes in the same order.\nSmall batches are hashed in this process, since starting the workers would cost more than it saves."""
+        passwords = list(passwords)
+        if len(passwords) < chunkSize * 2 or self.workers == 1:
+            return [self.hash(x) for x in passwords]
+        with self.__lock:
+            if self.__executor == None:
+                self.__executor = concurrent.futures.ProcessPoolExecutor(max_workers = self.workers)
+            executor = self.__executor
+        return list(executor.map(self.hash, passwords, chunksize = chunkSize))
+
+    def close(self):
+        """Stops the worker processes used by hashMany, if they were started."""
+        with self.__lock:
+            if self.__executor != None:
+                self.__executor.shutdown()
+                self.__executor = None
+
+    def __derive(algorithm, parameters, password, salt):
+        if algorithm == "pbkdf2-sha256":
+            return sha.pbkdf2_hmac("sha256", password.encode(encoding="UTF-8"), salt, int(parameters))
+        if algorithm == "scrypt":
+            n, r, p = (int(x) for x in parameters.split(","))
+            return sha.scrypt(password.encode(encoding="UTF-8"), salt = salt, n = n, r = r, p = p, maxmem = 128 * n * r * p + 1048576)
+        raise ValueError(f"Unknown password hashing algorithm '{algorithm}'.")
+
+class ScriptError(ValueError):
+    """Raised when a script can't be compiled, such as a block without an 'end'."""
+    pass
+
+class CompiledScript():
+    """A compiled script. 'instructions' is a tuple of (command, arguments, target) tuples and 'functions' maps each function's\nname to the index of its first instruction, so a function can be called from anywhere in the script, even above its definition."""
+    def __init__(self, instructions, functions):
+        self.instructions = instructions
+        self.functions = functions
+
+class ScriptCompiler():
+    """Parses script files into CompiledScripts made of immutable (command, arguments, target) instructions. Compiled scripts are cached\nby path and only parsed again once the file changes, so a script can be run any number of times without reparsing.\nBlocks ('while', 'foreach' and 'function') are matched with their 'end' while compiling, and 'target' holds the index\nof the instruction to jump to, so running a loop or calling a function never searches the script."""
+    blockKeywords = ("while", "foreach", "function")
+    loopKeywords = ("while", "foreach")
+
+    def __init__(self):
+        self.__cache = {}
+        self.__lock = threading.Lock()
+
+    def compile(self, path):
+        """Returns the CompiledScript for the script at 'path'. Raises IOError if the script can't be read and ScriptError if it is invalid."""
+        status = os.stat(path)
+        version = (status.st_mtime_ns, status.st_size)
+        with self.__lock:
+            cached = self.__cache.get(path, None)
+            if cached != None and cached[0] == version:
+                return cached[1]
+        with open(path, "r") as fileRead:
+            script = ScriptCompiler.compileLines(fileRead)
+        with self.__lock:
+            self.__cache[path] = (version, script)
+        return script
+
+    def compileLines(lines):
+        """Returns the CompiledScript for an iterable of script lines, skipping blank ones. Raises ScriptError if the blocks don't line up."""
+        instructions = []
+        functions = {}
+        blocks = []
+        for number, line in enumerate(lines, 1):
+            if len(line.strip()) == 0:
+                continue
+            command, args = Utilities.parseCommand(line)
+            target = None
+            if command in ScriptCompiler.blockKeywords:
+                ScriptCompiler.__checkBlock(number, command, args)
+                if command == "function":
+                    if args[0] in functions:
+                        raise ScriptError(f"Line {number}: The function '{args[0]}' is already defined.")
+                    functions[args[0]] = len(instructions) + 1
+                blocks.append(len(instructions))
+            elif command == "end":
+                if len(blocks) == 0:
+                    raise ScriptError(f"Line {number}: 'end' without a 'while', 'foreach' or 'function'.")
+                target = blocks.pop()
+                instructions[target][2] = len(instructions)
+            elif command == "break":
+                loops = [x for x in blocks if instructions[x][0] in ScriptCompiler.loopKeywords and not any(instructions[y][0] == "function" for y in blocks if y > x)]
+                if len(loops) == 0:
+                    raise ScriptError(f"Line {number}: 'break' outside of a loop.")
+                target = loops[-1]
+            elif command == "call" and len(args) != 1:
+                raise ScriptError(f"Line {number}: Usage is 'call [function]'.")
+            instructions.append([command, tuple(args), target])
+        if len(blocks) > 0:
+            raise ScriptError(f"The '{instructions[blocks[-1]][0]}' block starting at instruction {blocks[-1] + 1} has no 'end'.")
+        return CompiledScript(tuple(tuple(x) for x in instructions), functions)
+
+    def __checkBlock(number, command, args):
+        if command == "while" and len(args) != 3:
+            raise ScriptError(f"Line {number}: Usage is 'while [variable] [operator] [value]'.")
+        if command == "foreach" and (len(args) != 3 or args[1].lower() != "in"):
+            raise ScriptError(f"Line {number}: Usage is 'foreach [variable] in [list variable]'.")
+        if command == "function" and len(args) != 1:
+            raise ScriptError(f"Line {number}: Usage is 'function [name]'.")
+
+    def clear(self):
+        """Forgets every compiled script."""
+        with self.__lock:
+            self.__cache.clear()
+
+class ScriptFrame():
+    """The position of one running script or function call. 'loops' holds the iterator of each 'foreach' that is in progress."""
+    def __init__(self, script, position = 0, isCall = False):
+        self.script = script
+        self.instructions = script.instructions
+        self.position = position
+        self.isCall = isCall
+        self.loops = {}
+
 class CommandProcessor2():
     """Functions similarly to JUtils' CommandProcessor class, but it builds upon it and improves."""
     def __init__(self, commands = {}):
         self.commands = commands
-        self.queue = []
+        self.queue = collections.deque()
+        self.compiler = ScriptCompiler()
+        self.frames = []
+        self.steps = 0
+        self.iterations = 0
+        self.lock = threading.RLock()
+        self.scheduler = Scheduler(self)
+
+    def __parse(commands):
+        return [Utilities.parseCommand(x) if type(x) is str else x for x in commands]
 
     def queueCommands(self, commands):
         """Input a list of commands, either parsed or non-parsed, to be queue and executed later."""
-        self.queue += AdvancedMap(commands).selectivelyMapResults(lambda x: type(x) is str, lambda x: Utilities.parseCommand(x))
+        self.queue.extend(CommandProcessor2.__parse(commands))
 
     def forceQueueCommands(self, commands):
         """Does the same thing as queueCommands, but forces the inputted commands to the front of the queue."""
-        self.queue = AdvancedMap(commands).selectivelyMapResults(lambda x: type(x) is str, lambda x: Utilities.parseCommand(x)) + self.queue
+        self.queue.extendleft(reversed(CommandProcessor2.__parse(commands)))
 
     def executeNextInQueue(self):
-        """Execute stored commands."""
-        if not self.isQueueClear():
-            command = self.queue.pop(0)
-            self.executeCommand(command[0], command[1])
-        return not(len(self.queue) == 0)
+        """Execute stored commands. Queued commands run first, then the next instruction of the running script."""
+        if len(self.queue) > 0:
+            command = self.queue.popleft()
+            if command[0] in ("break", "return", "call") and len(self.frames) > 0:
+                self.__escape(command[0], [Utilities.substitute(x, storedVariables) for x in command[1]])
+            else:
+                self.executeCommand(command[0], command[1])
+        elif len(self.frames) > 0:
+            self.__step()
+        return not self.isQueueClear()
 
     def isQueueClear(self):
-        """Returns true if the command queue is clear."""
-        return len(self.queue) == 0
+        """Returns true if the command queue is clear and no script is running."""
+        return len(self.queue) == 0 and len(self.frames) == 0
 
     def clearCommandQueue(self):
-        """Clears command queue."""
+        """Clears command queue and stops any running script."""
         self.queue.clear()
+        self.frames.clear()
+
+    def runScript(self, script):
+        """Starts running a CompiledScript, one instruction per call to executeNextInQueue. Resets the step and iteration counters."""
+        self.steps = 0
+        self.iterations = 0
+        self.frames.append(ScriptFrame(script))
+
+    def __step(self):
+        global storedVariables
+        frame = self.frames[-1]
+        if frame.position >= len(frame.instructions):
+            self.__leave()
+            return
+        instruction = frame.instructions[frame.position]
+        self.steps += 1
+        frame.position += 1
+        handler = CommandProcessor2.__controlFlow.get(instruction[0], None)
+        if handler == None:
+            self.executeCommand(instruction[0], instruction[1])
+        else:
+            handler(self, frame, frame.position - 1, instruction, [Utilities.substitute(x, storedVariables) for x in instruction[1]])
+
+    def __escape(self, command, args):
+        # A 'break', 'return' or 'call' queued by another command, such as 'conditional', applies to the instruction that queued it.
+        frame = self.frames[-1]
+        if command == "return":
+            self.__return(frame, None, None, args)
+            return
+        if command == "call":
+            if len(args) != 1:
+                print("Usage is 'call [function]'.")
+                return
+            self.__call(frame, None, None, args)
+            return
+        index = frame.position - 1
+        for opener in range(index, -1, -1):
+            instruction = frame.instructions[opener]
+            if instruction[0] in ScriptCompiler.blockKeywords and instruction[2] > index:
+                if instruction[0] in ScriptCompiler.loopKeywords:
+                    self.__break(frame, index, (command, (), opener), ())
+                    return
+                break
+        print("There is no loop to break out of.")
+
+    def __leave(self):
+        # Ends the innermost frame. Once the whole script is done, its counters are stored so scripts can be profiled.
+        self.frames.pop()
+        if len(self.frames) == 0:
+            storedVariables.update({"script-steps": self.steps, "script-iterations": self.iterations})
+
+    def __while(self, frame, index, instruction, args):
+        if Utilities.compareValues(storedVariables.get(args[0], args[0]), args[1], args[2]):
+            self.iterations += 1
+        else:
+            frame.position = instruction[2] + 1
+
+    def __foreach(self, frame, index, instruction, args):
+        if index not in frame.loops:
+            frame.loops[index] = iter(Utilities.toList(storedVariables.get(args[2], None)))
+        try:
+            storedVariables[args[0]] = next(frame.loops[index])
+            self.iterations += 1
+        except StopIteration:
+            del frame.loops[index]
+            frame.position = instruction[2] + 1
+
+    def __end(self, frame, index, instruction, args):
+        opener = frame.instructions[instruction[2]]
+        if opener[0] == "function":
+            self.__leave()
+        else:
+            frame.position = instruction[2]
+
+    def __break(self, frame, index, instruction, args):
+        frame.loops.pop(instruction[2], None)
+        frame.position = frame.instructions[instruction[2]][2] + 1
+
+    def __function(self, frame, index, instruction, args):
+        # Functions are only run by 'call', so reaching a definition skips over its body.
+        frame.position = instruction[2] + 1
+
+    def __call(self, frame, index, instruction, args):
+        start = frame.script.functions.get(args[0], None)
+        if start == None:
+            print(f"Unknown function '{args[0]}'.")
+            return
+        self.frames.append(ScriptFrame(frame.script, start, True))
+
+    def __return(self, frame, index, instruction, args):
+        while len(self.frames) > 0 and not self.frames[-1].isCall:
+            self.__leave()
+        if len(self.frames) > 0:
+            self.__leave()
+
+    __controlFlow = {"while": __while, "foreach": __foreach, "end": __end, "break": __break, "function": __function, "call": __call, "return": __return}
+
+    def executeAll(self, command, args = []):
+        """Executes a command and everything it queues, such as a script, while holding the processor's lock so scheduled jobs don't interleave with it.\nIf anything raises, whatever is still queued is dropped so it doesn't run with the next command."""
+        with self.lock:
+            try:
+                self.executeCommand(command, args)
+                while self.executeNextInQueue():
+                    pass
+            except:
+                self.clearCommandQueue()
+                raise
 
     def executeCommands(self, commands):
         """Input a list of commands, either parsed or non-parsed, to be executed."""
-        AdvancedMap(commands).selectivelyMapResults(lambda x: type(x) is str, lambda x: Utilities.parseCommand(x)).forEach(lambda x: self.executeCommand(x[0], x[1]))
+        for command in CommandProcessor2.__parse(commands):
+            self.executeCommand(command[0], command[1])
 
     def executeCommand(self, command, args = []):
         """Input a command and its arguments to execute the command."""
         global storedVariables
-        args = AdvancedMap(args).mapResults(lambda x: Utilities.replaceAll(x, storedVariables)).getResults()
+        args = [Utilities.substitute(x, storedVariables) for x in args]
         try:
             if type(command) is str:
                 command = self.commands[command]
@@ -250,8 +1050,13 @@ class CommandProcessor2():
         if len(args) < command.getMinimumArguments():
             print("Usage: () indicates an optional argument, [] indicates a required argument:\n" + command.getUsage())
         else:
+            if self.scheduler.isRunningJob() and self.isInteractive(command, args):
+                raise RuntimeError(f"'{command.getName()}' needs the terminal and can't run in a scheduled job.")
             if command.isEnabled():
-                command.execute(args)
+                if instrumentation.enabled:
+                    instrumentation.executeCommand(command, args)
+                else:
+                    command.execute(args)
             else:
                 reason = command.getDisabledReason()
                 print(f"This command has been disabled! [{reason}]")
@@ -276,12 +1081,82 @@ class CommandProcessor2():
     
     def getCommandsByName(self, name):
         """Returns a list of commands that contain 'name' in their name."""
-        return AdvancedMap(Utilities.createEmbeddedList(self.commands.keys(), self.commands.values())).filterResults(lambda x: name.lower() in x[0]).mapResults(lambda x: x[1]).getResults()
+        return AdvancedMap(self.commands.items(), lazy = True).filterResults(lambda x: name.lower() in x[0]).mapResults(lambda x: x[1]).getResults()
 
     def getRegisteredCommands(self):
         """Returns a list of all registered commands."""
         return list(self.commands.values())
 
+    def isInteractive(self, command, args = []):
+        """Returns true if a command, or its name, prompts for input or closes the terminal when run with args. Such commands can't be scheduled.\nCommands say so with an optional '.isInteractive(args)' method, commands without one are not interactive."""
+        if type(command) is str:
+            command = self.getExactCommandByName(command)
+        return command != None and getattr(command, "isInteractive", None) != None and command.isInteractive(args)
+
+class Scheduler():
+    """Runs commands on an interval from a background thread, so periodic jobs keep running while the terminal waits for input.\nEach run is timed from when the previous run was due rather than when it finished, so jobs don't drift. Runs that were\nmissed because a command took too long are skipped instead of being run back to back. Jobs run under the processor's lock,\nso commands that prompt for input or close the terminal can't be scheduled, and fail if a scheduled script runs them."""
+    def __init__(self, processor):
+        self.processor = processor
+        self.jobs = {}
+        self.__condition = threading.Condition()
+        self.__thread = None
+
+    def schedule(self, name, interval, command, args = []):
+        """Runs command with args every 'interval' milliseconds, starting one interval from now. Replaces any job with the same name."""
+        if interval <= 0:
+            raise ValueError("The interval must be positive.")
+        if self.processor.isInteractive(command, args):
+            raise ValueError(f"'{command}' needs the terminal and can't be scheduled.")
+        with self.__condition:
+            self.jobs[name] = {"command": command, "args": list(args), "interval": interval, "next": time.monotonic() + interval / 1000, "runs": 0, "skipped": 0, "errors": 0}
+            if self.__thread == None:
+                self.__thread = threading.Thread(target = self.__run, name = "jutils-scheduler", daemon = True)
+                self.__thread.start()
+            self.__condition.notify()
+
+    def unschedule(self, name):
+        """Stops a job. Returns False if there is no job with that name."""
+        with self.__condition:
+            found = self.jobs.pop(name, None) != None
+            self.__condition.notify()
+            return found
+
+    def getJobs(self):
+        """Returns a copy of every job, with 'next' in milliseconds from now."""
+        with self.__condition:
+            now = time.monotonic()
+            return {x: dict(y, next = max(0, round((y["next"] - now) * 1000))) for x, y in self.jobs.items()}
+
+    def isRunningJob(self):
+        """Returns true when called from a scheduled job."""
+        return self.__thread != None and threading.current_thread() is self.__thread
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                now = time.monotonic()
+                due = [x for x, y in self.jobs.items() if y["next"] <= now]
+                if len(due) == 0:
+                    self.__condition.wait(min([x["next"] for x in self.jobs.values()], default = now + 60) - now)
+                    continue
+                for name in due:
+                    job = self.jobs[name]
+                    interval = job["interval"] / 1000
+                    missed = int((now - job["next"]) // interval)
+                    job["next"] += interval * (missed + 1)
+                    job["skipped"] += missed
+            for name in due:
+                job = self.jobs.get(name, None)
+                if job != None:
+                    try:
+                        self.processor.executeAll(job["command"], job["args"])
+                        outcome = "runs"
+                    except:
+                        Utilities.logTracebackToFile("errors.log")
+                        outcome = "errors"
+                    with self.__condition:
+                        job[outcome] += 1
+
 # === Standalone Script === #
 class JUtilsCommand():
     def getName(self):
@@ -529,14 +1404,13 @@ class RunScriptCommand():
 
     def execute(self, args):
         try:
-            commands = []
-            with open(args[0], "r") as fileRead:
-                commands = AdvancedMap(fileRead).mapResults(lambda x: x.strip()).filterResults(lambda x: len(x) > 0).getResults()
-            global storedVariables
+            script = self.processor.compiler.compile(args[0])
             self.processor.clearCommandQueue()
-            self.processor.forceQueueCommands(commands)
+            self.processor.runScript(script)
         except IOError:
             print("The script does not exist!")
+        except ScriptError as e:
+            print(f"The script is invalid: {e}")
         except:
             print("An error occurred while trying to run the script.")
 
@@ -550,7 +1424,7 @@ class RunScriptCommand():
         return "Executes the commands in the given script."
     
     def getLongDescription(self):
-        return ["Executes the commands in the given script."]
+        return ["Executes the commands in the given script.", "Scripts can use 'while [variable] [operator] [value]', 'foreach [variable] in [list variable]' and 'function [name]' blocks,", "each closed by 'end'. Use 'break' to leave a loop, 'call [name]' to run a function and 'return' to leave it.", "The number of steps and loop iterations are stored in %script-steps% and %script-iterations% when the script ends."]
 
     def isEnabled(self):
         return True
@@ -560,22 +1434,108 @@ class WaitCommand():
         return "wait"
 
     def execute(self, args):
-        start = Utilities.getSystemTime()
-        time = 1000 if len(args) == 0 else Utilities.tryParse(args[0], 1000)
-        while start + time > Utilities.getSystemTime():
-            pass
+        delay = 1000 if len(args) == 0 else Utilities.tryParse(args[0], 1000)
+        time.sleep(max(0, delay) / 1000)
 
     def getMinimumArguments(self):
         return 0
     
     def getUsage(self):
-        return "wait"
+        return "wait (milliseconds)"
     
     def getShortDescription(self):
         return "Waits the specified milliseconds."
     
     def getLongDescription(self):
-        return ["Waits the specified milliseconds."]
+        return ["Waits the specified milliseconds, one second by default."]
+
+    def isEnabled(self):
+        return True
+
+class ScheduleCommand():
+    def __init__(self, processor):
+        self.processor = processor
+
+    def getName(self):
+        return "schedule"
+
+    def execute(self, args):
+        interval = Utilities.tryParse(args[1], 0)
+        if interval <= 0:
+            print("The interval must be a positive number of milliseconds.")
+            return
+        try:
+            self.processor.scheduler.schedule(args[0], interval, args[2].lower(), args[3:])
+        except ValueError as e:
+            print(e)
+            return
+        print(f"'{args[0]}' will run every {interval}ms.")
+
+    def getMinimumArguments(self):
+        return 3
+    
+    def getUsage(self):
+        return "schedule [name] [interval] [command] (arguments...)"
+    
+    def getShortDescription(self):
+        return "Runs a command every interval milliseconds."
+    
+    def getLongDescription(self):
+        return ["Runs a command every interval milliseconds in the background, starting one interval from now.", "Use 'run [script]' as the command to schedule a script, and a name that is already scheduled to replace it.", "Runs are timed from when they were due, so they don't drift. Runs missed while a command was busy are skipped.", "Variables are inserted when the command is scheduled, schedule a script to use their values at each run.", "Commands that prompt for input, such as 'exit', can't be scheduled."]
+
+    def isEnabled(self):
+        return True
+
+class UnscheduleCommand():
+    def __init__(self, processor):
+        self.processor = processor
+
+    def getName(self):
+        return "unschedule"
+
+    def execute(self, args):
+        print(f"'{args[0]}' was unscheduled." if self.processor.scheduler.unschedule(args[0]) else f"Nothing named '{args[0]}' is scheduled.")
+
+    def getMinimumArguments(self):
+        return 1
+    
+    def getUsage(self):
+        return "unschedule [name]"
+    
+    def getShortDescription(self):
+        return "Stops a scheduled command."
+    
+    def getLongDescription(self):
+        return ["Stops a scheduled command."]
+
+    def isEnabled(self):
+        return True
+
+class SchedulesCommand():
+    def __init__(self, processor):
+        self.processor = processor
+
+    def getName(self):
+        return "schedules"
+
+    def execute(self, args):
+        print("{:^20}|{:^24}|{:^11}|{:^7}|{:^8}|{:^8}|{:^10}".format("Name", "Command", "Interval", "Runs", "Skipped", "Errors", "Next (ms)"))
+        print("-" * 92)
+        for name, job in sorted(self.processor.scheduler.getJobs().items()):
+            command = " ".join([job["command"]] + job["args"])
+            print(" {: <19}| {: <23}| {: <10}| {: <6}| {: <7}| {: <7}| {}".format(name if len(name) < 19 else name[:16] + "...", command if len(command) < 23 else command[:20] + "...", job["interval"], job["runs"], job["skipped"], job["errors"], job["next"]))
+
+    def getMinimumArguments(self):
+        return 0
+    
+    def getUsage(self):
+        return "schedules"
+    
+    def getShortDescription(self):
+        return "Lists the scheduled commands."
+    
+    def getLongDescription(self):
+        return ["Lists the scheduled commands, how often they ran and when they run next.", "'Runs' counts runs that finished, 'Errors' runs that failed and 'Skipped' runs that were missed because a command was still busy."]
 
     def isEnabled(self):
         return True
@@ -633,6 +1593,55 @@ class VariablesCommand():
     def isEnabled(self):
         return True
 
+class StatsCommand():
+    def getName(self):
+        return "stats"
+
+    def execute(self, args):
+        option = args[0].lower() if len(args) > 0 else ""
+        if option in ("on", "off"):
+            instrumentation.enable() if option == "on" else instrumentation.disable()
+            print("Instrumentation " + ("enabled." if option == "on" else "disabled."))
+            return
+        if option == "reset":
+            instrumentation.reset()
+            print("Stats cleared!")
+            return
+        if option == "export":
+            filename = args[1] if len(args) > 1 else "metrics.prom"
+            with open(filename, "w") as fileWrite:
+                fileWrite.write(instrumentation.toPrometheus())
+            print(f"Stats written to '{filename}'.")
+            return
+
+        timings, counters, gauges = instrumentation.getStats()
+        if not instrumentation.enabled:
+            print("Instrumentation is off, use 'stats on' to start recording.")
+        print("{:^32}|{:^9}|{:^8}|{:^10}|{:^10}|{:^10}|{:^10}".format("Operation", "Calls", "Errors", "p50 (ms)", "p95 (ms)", "p99 (ms)", "Trips"))
+        print("-" * 95)
+        for name in sorted(timings.keys()):
+            timing = timings[name]
+            displayName = name if len(name) < 31 else name[:28] + "..."
+            roundTrips = counters.get(f"{name}.roundTrips", None)
+            print(" {: <31}| {: <8}| {: <7}| {: <9.3f}| {: <9.3f}| {: <9.3f}| {}".format(displayName, timing["count"], timing["errors"], timing["p50"], timing["p95"], timing["p99"], "" if roundTrips == None else round(roundTrips / timing["count"], 2)))
+        for name in sorted(gauges.keys()):
+            print(" {: <31}| {}".format(name, gauges[name]))
+
+    def getMinimumArguments(self):
+        return 0
+    
+    def getUsage(self):
+        return "stats (on|off|reset|export) (file)"
+    
+    def getShortDescription(self):
+        return "Shows how long operations and commands take."
+    
+    def getLongDescription(self):
+        return ["Shows call counts, errors and p50/p95/p99 latency for each operation and command.", "'Trips' is the average number of database round trips per command.", "'stats on' and 'stats off' start and stop recording, 'stats reset' clears it.", "'stats export (file)' writes everything in Prometheus text format, to 'metrics.prom' by default."]
+
+    def isEnabled(self):
+        return True
+
 class ExitCommand():
     def getName(self):
         return "exit"
@@ -655,17 +1664,18 @@ class ExitCommand():
     def isEnabled(self):
         return True
 
+    def isInteractive(self, args):
+        return True
+
 def runTerminal(header = "", commands = []):
     global storedVariables
     storedVariables = {}
     processor = CommandProcessor2()
     print(header)
-    processor.registerCommands([JUtilsCommand(), HelpCommand(processor), RunScriptCommand(processor), DefineCommand(), DefineIntCommand(), CompareCommand(), AddCommand(), PrintCommand(), ConditionalCommand(processor), WaitCommand(), VariablesCommand(), ClearMemoryCommand(), ExitCommand()] + commands)
+    processor.registerCommands([JUtilsCommand(), HelpCommand(processor), RunScriptCommand(processor), DefineCommand(), DefineIntCommand(), CompareCommand(), AddCommand(), PrintCommand(), ConditionalCommand(processor), WaitCommand(), ScheduleCommand(processor), UnscheduleCommand(processor), SchedulesCommand(processor), VariablesCommand(), ClearMemoryCommand(), StatsCommand(), ExitCommand()] + commands)
     while True:
         parsedCommand = Utilities.getParsedInput("> ")
-        processor.executeCommand(parsedCommand[0], parsedCommand[1])
-        while processor.executeNextInQueue():
-            pass
+        processor.executeAll(parsedCommand[0], parsedCommand[1])
 
 if __name__ == "__main__":
     runTerminal("[JUtils2 v" + Compatibility.getVersionString() + "]\nCreated by Ryan Jones @ 2018\n\nUse the 'help' command for a detailed list of commands.\n")
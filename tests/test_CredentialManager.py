@@ -0,0 +1,301 @@
+import asyncio
+import contextlib
+import io
+import sqlite3
+import unittest
+
+import CredentialManager as cm
+import JUtils2 as jutils
+
+class StandInTestCase(unittest.TestCase):
+    # Each test gets a fresh in-memory SQLite database, the same stand-in the benchmarks use.
+    def setUp(self):
+        info = cm.DatabaseInfo(None, None, ":memory:", None, None, "sqlite")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(info.attemptConnection())
+            cm.CredentialManager.setup()
+
+    def tearDown(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            cm.CredentialManager.gracefulExit()
+
+class ConnectionPoolTest(StandInTestCase):
+    def test_execute_recovers_when_every_idle_connection_was_dropped(self):
+        borrowed = [cm.pool.acquire() for x in range(3)]
+        for pooled in borrowed:
+            cm.pool.release(pooled)
+            pooled.connection.close()
+
+        self.assertEqual(cm.CredentialManager.execute("SELECT 1"), [(1,)])
+        # The other dropped connections are validated and replaced instead of being handed out.
+        for x in range(3):
+            self.assertEqual(cm.CredentialManager.execute("SELECT 1"), [(1,)])
+
+    def test_statement_errors_keep_the_connection(self):
+        before = cm.CredentialManager.getConnectionStats()
+        for statement, params in (("SELECT 1; SELECT 2", None), ("SELECT %(a)s", {"a": [1]})):
+            with self.assertRaises(sqlite3.ProgrammingError):
+                cm.CredentialManager.execute(statement, params)
+        after = cm.CredentialManager.getConnectionStats()
+        self.assertEqual((after["retries"], after["discarded"], after["created"]), (before["retries"], before["discarded"], before["created"]))
+
+    def test_a_plain_backend_wraps_a_connect_function(self):
+        storage = cm.StorageBackend(lambda: sqlite3.connect(":memory:"))
+        connection = storage.connect()
+        execute = lambda statement: connection.execute(statement).fetchall()
+        self.assertFalse(storage.getSchemaLayout(execute)["exists"])
+        execute("CREATE TABLE `Credential_Table` (id VARCHAR(16))")
+        self.assertEqual(storage.getSchemaLayout(execute), {"exists": True, "indexes": {}, "unique": set()})
+        connection.close()
+
+class FlushTest(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        cm.CredentialManager.importUsers([{"id": f"id{x}", "username": f"user{x}", "pwhash": "hash", "nickname": f"nick{x}", "role": "member"} for x in range(5)])
+        self.users = [cm.CredentialManager.getUserById(f"id{x}") for x in range(5)]
+
+    def readRows(self):
+        return {x[0]: x[1:] for x in cm.CredentialManager.execute("SELECT id,nickname,role,locked FROM `Credential_Table`")}
+
+    def test_only_modified_columns_of_dirty_users_are_written_in_batches(self):
+        self.users[0].setNickname("renamed")
+        self.users[1].setRole("admin")
+        self.users[2].setLocked(True)
+        statements = []
+        execute = cm.BackendCursor.execute
+        def countingExecute(cursor, statement, params = None):
+            statements.append(statement)
+            return execute(cursor, statement, params)
+        cm.BackendCursor.execute = countingExecute
+        try:
+            self.assertEqual(cm.CredentialManager.flush(2), 3)
+        finally:
+            cm.BackendCursor.execute = execute
+
+        self.assertEqual(len([x for x in statements if x.startswith("UPDATE")]), 2)
+        rows = self.readRows()
+        self.assertEqual(rows["id0"], ("renamed", "member", 0))
+        self.assertEqual(rows["id1"], ("nick1", "admin", 0))
+        self.assertEqual(rows["id2"], ("nick2", "member", 1))
+        self.assertEqual(rows["id3"], ("nick3", "member", 0))
+        self.assertFalse(any(x.isDirty() for x in self.users))
+        self.assertEqual(cm.CredentialManager.flush(), 0)
+
+    def test_a_user_modified_after_another_write_keeps_the_other_columns(self):
+        cm.CredentialManager.execute("UPDATE `Credential_Table` SET role = 'changed' WHERE id = 'id4'")
+        self.users[4].setNickname("renamed")
+        self.assertEqual(cm.CredentialManager.flush(), 1)
+        self.assertEqual(self.readRows()["id4"], ("renamed", "changed", 0))
+
+class UserCacheTest(StandInTestCase):
+    def test_a_replaced_user_is_written_back_first(self):
+        cm.CredentialManager.importUsers([{"id": "id1", "username": "user1", "pwhash": "hash", "nickname": "old", "role": "member"}])
+        cached = cm.CredentialManager.getUserById("id1")
+        cached.setNickname("new")
+        fresh = cm.CredentialManager.getUserById("id1", False)
+        self.assertIsNot(fresh, cached)
+        self.assertEqual(cm.CredentialManager.execute("SELECT nickname FROM `Credential_Table`"), [("new",)])
+        self.assertEqual(fresh.getNickname(), "new")
+        self.assertFalse(fresh.isDirty())
+        self.assertIs(cm.CredentialManager.getUserById("id1"), fresh)
+
+    def test_the_replacement_keeps_its_own_changes(self):
+        saved = []
+        cache = cm.UserCache(writeBack = lambda user: saved.append(user.getModifiedFields()) or user.clearModifiedFields())
+        previous = cm.User("id1", "user1", "old", "member", 0, False)
+        previous.setNickname("previous")
+        previous.setRole("admin")
+        cache.put(previous)
+        replacement = cm.User("id1", "user1", "old", "member", 0, False)
+        replacement.setNickname("replacement")
+        cache.put(replacement)
+        self.assertEqual(saved, [{"nickname", "role"}])
+        self.assertEqual((replacement.getNickname(), replacement.getRole()), ("replacement", "admin"))
+        self.assertEqual(replacement.getModifiedFields(), {"nickname"})
+        self.assertIs(cache.getByName("user1"), replacement)
+
+class ReplicaTest(StandInTestCase):
+    # The primary and the replica are separate in-memory databases, holding different nicknames for the same user.
+    def setUp(self):
+        info = cm.DatabaseInfo(None, None, ":memory:", None, None, "sqlite")
+        info.replicas.append(cm.DatabaseInfo(None, None, ":memory:", None, None, "sqlite"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertTrue(info.attemptConnection())
+            cm.CredentialManager.setup()
+        cm.CredentialManager.execute("INSERT INTO `Credential_Table` (id,username,nickname,locked) VALUES ('id1','user1','primary',0)")
+        self.replica = cm.replicas.replicas[0]
+        with self.replica.pool.borrow() as pooled:
+            pooled.connection.execute("CREATE TABLE `Credential_Table` (id VARCHAR(16) NOT NULL PRIMARY KEY, username VARCHAR(16), pwhash VARCHAR(256), nickname VARCHAR(16), role VARCHAR(16), creation BIGINT, locked BOOLEAN)")
+            pooled.connection.execute("INSERT INTO `Credential_Table` (id,username,nickname,locked) VALUES ('id1','user1','replica',0)")
+
+    def test_reads_go_to_the_replica_until_the_user_is_written(self):
+        user = cm.CredentialManager.getUserById("id1", False)
+        self.assertEqual(user.getNickname(), "replica")
+        user.setNickname("written")
+        cm.CredentialManager.updateUser(user)
+
+        pinnedReads = cm.CredentialManager.getConnectionStats()["pinnedReads"]
+        self.assertEqual(cm.CredentialManager.getUserById("id1", False).getNickname(), "written")
+        self.assertEqual(cm.CredentialManager.getUserByName("user1", False).getNickname(), "written")
+        self.assertEqual(cm.CredentialManager.getConnectionStats()["pinnedReads"], pinnedReads + 2)
+
+    def test_a_failing_replica_is_ejected_and_reads_fall_back_to_the_primary(self):
+        self.replica.pool.close()
+        for x in range(cm.ReplicaRouter.maxFailures):
+            self.assertEqual(cm.CredentialManager.getUserById("id1", False).getNickname(), "primary")
+        stats = cm.CredentialManager.getReplicaStats()[0]
+        self.assertEqual((stats["healthy"], stats["failures"], stats["ejections"]), (False, cm.ReplicaRouter.maxFailures, 1))
+        self.assertIsNone(cm.replicas.choose())
+
+        # Once the ejection runs out the replica is tried again.
+        self.replica.ejectedUntil = 0
+        self.assertIs(cm.replicas.choose(), self.replica)
+
+class ImportUsersTest(StandInTestCase):
+    def test_imported_keys_are_no_longer_reported_available(self):
+        self.assertEqual(cm.CredentialManager.checkAvailability("id1", "user1"), (True, True))
+        totals = cm.CredentialManager.importUsers([{"id": "id1", "username": "user1", "pwhash": "hash"}])
+        self.assertEqual(totals["imported"], 1)
+        self.assertEqual(cm.CredentialManager.checkAvailability("id1", "user1"), (False, False))
+
+class CreateUserTest(StandInTestCase):
+    def test_conflicts_are_reported_by_column(self):
+        create = lambda userId, username: cm.CredentialManager.createUser(cm.User(userId, username, None, None, 0, False))
+        self.assertEqual(create("id1", "user1"), cm.CredentialManager.CREATED)
+        self.assertEqual(create("id1", "user2"), cm.CredentialManager.ID_TAKEN)
+        self.assertEqual(create("id2", "user1"), cm.CredentialManager.USERNAME_TAKEN)
+
+    def test_mysql_duplicate_keys_map_to_columns(self):
+        class DuplicateKey(Exception):
+            def __init__(self, errno, msg):
+                Exception.__init__(self, msg)
+                self.errno = errno
+                self.msg = msg
+        backend = cm.MySQLBackend.__new__(cm.MySQLBackend)
+        self.assertEqual(backend.conflictColumn(DuplicateKey(1062, "Duplicate entry 'a' for key 'Credential_Table.username_index'")), "username")
+        self.assertEqual(backend.conflictColumn(DuplicateKey(1062, "Duplicate entry 'a' for key 'PRIMARY'")), "id")
+        self.assertEqual(backend.conflictColumn(DuplicateKey(1048, "Column 'username' cannot be null")), None)
+
+class VerifyCredentialsTest(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.hasher = cm.CredentialManager.passwordHasher
+        self.cache = cm.CredentialManager.verificationCache
+        self.verified = []
+        hasher = jutils.PasswordHasher(iterations = 1000)
+        verify = hasher.verify
+        hasher.verify = lambda password, stored: self.verified.append(stored) or verify(password, stored)
+        cm.CredentialManager.passwordHasher = hasher
+        cm.CredentialManager.verificationCache = None
+        cm.CredentialManager.importUsers([{"id": "id1", "username": "user1", "password": "secret"}, {"id": "id2", "username": "user2", "password": "secret", "locked": "true"}])
+
+    def tearDown(self):
+        cm.CredentialManager.passwordHasher = self.hasher
+        cm.CredentialManager.verificationCache = self.cache
+        StandInTestCase.tearDown(self)
+
+    def test_unknown_users_are_hashed_like_known_ones(self):
+        self.assertEqual(cm.CredentialManager.verifyCredentials("nobody", "secret"), cm.CredentialManager.INVALID)
+        self.assertEqual(len(self.verified), 1)
+        self.assertTrue(self.verified[0].startswith("$pbkdf2-sha256$1000$"))
+
+    def test_locked_users_are_only_reported_with_the_right_password(self):
+        self.assertEqual(cm.CredentialManager.verifyCredentials("user2", "wrong"), cm.CredentialManager.INVALID)
+        self.assertEqual(cm.CredentialManager.verifyCredentials("user2", "secret"), cm.CredentialManager.LOCKED)
+        self.assertEqual(cm.CredentialManager.verifyCredentials("user1", "secret"), cm.CredentialManager.VERIFIED)
+        self.assertEqual(len(self.verified), 3)
+
+class BulkUpdateCommandTest(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        cm.CredentialManager.importUsers([{"id": f"id{x}", "username": f"{'staff' if x < 3 else 'guest'}{x}", "pwhash": "hash", "nickname": "old", "role": "member"} for x in range(5)])
+
+    def runCommand(self, command, args):
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            command.execute(args)
+        return output.getvalue()
+
+    def readNicknames(self):
+        return dict(cm.CredentialManager.execute("SELECT username,nickname FROM `Credential_Table`"))
+
+    def test_bulknick_sets_the_nickname_of_matching_users(self):
+        cached = cm.CredentialManager.getUserByName("staff0")
+        self.runCommand(cm.BulkNickCommand(), ["crew", "--prefix", "staff", "--yes"])
+        self.assertEqual(self.readNicknames(), {"staff0": "crew", "staff1": "crew", "staff2": "crew", "guest3": "old", "guest4": "old"})
+        self.assertEqual(cached.getNickname(), "crew")
+        self.assertEqual(jutils.storedVariables["bulk-updated"], 3)
+
+    def test_values_are_checked_before_anything_is_written(self):
+        output = self.runCommand(cm.BulkNickCommand(), ["a" * 17, "--prefix", "staff", "--yes"])
+        self.assertIn("The nickname can be at most 16 characters.", output)
+        self.assertEqual(set(self.readNicknames().values()), {"old"})
+        self.assertEqual(cm.BulkRoleCommand().getValues("admin"), {"role": "admin"})
+        self.assertEqual(cm.BulkRoleCommand().describe("admin"), "Set the role to 'admin'")
+
+class ResetPasswordsTest(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        self.hasher = cm.CredentialManager.passwordHasher
+        self.batches = []
+        hasher = jutils.PasswordHasher(iterations = 1000)
+        hashMany = hasher.hashMany
+        hasher.hashMany = lambda passwords: self.batches.append(list(passwords)) or hashMany(self.batches[-1])
+        cm.CredentialManager.passwordHasher = hasher
+        cm.CredentialManager.importUsers([{"id": f"id{x}", "username": f"user{x}", "password": "old"} for x in range(5)])
+
+    def tearDown(self):
+        cm.CredentialManager.passwordHasher = self.hasher
+        StandInTestCase.tearDown(self)
+
+    def test_passwords_are_hashed_together_and_accounts_locked(self):
+        cached = cm.CredentialManager.getUserByName("user1")
+        self.assertEqual(cm.CredentialManager.verifyCredentials("user1", "old"), cm.CredentialManager.VERIFIED)
+        batches = len(self.batches)
+        totals = cm.CredentialManager.resetPasswords({f"user{x}": f"new{x}" for x in range(4)}, chunkSize = 3)
+        self.assertEqual((totals["updated"], totals["failed"], len(totals["chunks"])), (4, 0, 2))
+        self.assertEqual(self.batches[batches:], [[f"new{x}" for x in range(4)]])
+        self.assertTrue(cached.isLocked())
+        self.assertEqual(cm.CredentialManager.verifyCredentials("user1", "old"), cm.CredentialManager.INVALID)
+        self.assertEqual(cm.CredentialManager.verifyCredentials("user1", "new1"), cm.CredentialManager.LOCKED)
+        self.assertEqual(cm.CredentialManager.verifyCredentials("user4", "old"), cm.CredentialManager.VERIFIED)
+
+class AsyncCredentialManagerTest(StandInTestCase):
+    def setUp(self):
+        StandInTestCase.setUp(self)
+        cm.CredentialManager.importUsers([{"id": f"id{x}", "username": f"user{x}", "pwhash": "hash"} for x in range(25)])
+        self.manager = cm.AsyncCredentialManager(workers = 4)
+
+    def tearDown(self):
+        self.manager.close()
+        StandInTestCase.tearDown(self)
+
+    def test_lookups_run_off_the_loop_and_hit_the_cache(self):
+        async def lookups():
+            byId = await self.manager.getUserById("id3")
+            byName = await self.manager.getUserByName("user3")
+            missing = await self.manager.getUserByName("nobody")
+            return (byId, byName, missing)
+        byId, byName, missing = asyncio.run(lookups())
+        self.assertEqual(byId.getUsername(), "user3")
+        self.assertIs(byName, byId)
+        self.assertIsNone(missing)
+        self.assertEqual(self.manager.getStats()["cacheHits"], 1)
+
+    def test_concurrent_lookups_for_one_key_share_one_query(self):
+        checkouts = cm.CredentialManager.getConnectionStats()["checkouts"]
+        async def lookups():
+            return await asyncio.gather(*[self.manager.getUserById("id7", False) for x in range(10)])
+        users = asyncio.run(lookups())
+        self.assertEqual(set(x.getUsername() for x in users), {"user7"})
+        self.assertEqual(cm.CredentialManager.getConnectionStats()["checkouts"] - checkouts, 1)
+        stats = self.manager.getStats()
+        self.assertEqual((stats["queries"], stats["coalesced"], stats["inFlight"]), (1, 9, 0))
+
+    def test_iterate_user_info_pages_through_every_user(self):
+        async def iterate():
+            return [x async for x in self.manager.iterateUserInfo(pageSize = 10)]
+        self.assertEqual(asyncio.run(iterate()), list(cm.CredentialManager.iterateUserInfo(10)))
+        self.assertEqual(len(asyncio.run(iterate())), 25)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,300 @@
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+
+import JUtils2 as jutils
+
+class RecordCommand():
+    def __init__(self):
+        self.calls = []
+
+    def getName(self):
+        return "record"
+
+    def execute(self, args):
+        self.calls.append(args[0])
+
+    def getMinimumArguments(self):
+        return 1
+
+    def isEnabled(self):
+        return True
+
+class CommandQueueTest(unittest.TestCase):
+    def setUp(self):
+        jutils.storedVariables = {}
+        self.record = RecordCommand()
+        self.processor = jutils.CommandProcessor2({})
+        self.processor.registerCommands([self.record])
+
+    def test_forced_commands_run_before_queued_ones(self):
+        self.processor.queueCommands(["record c", "record d"])
+        self.processor.forceQueueCommands(["record a", ("record", ["b"])])
+        while self.processor.executeNextInQueue():
+            pass
+        self.assertEqual(self.record.calls, ["a", "b", "c", "d"])
+        self.assertTrue(self.processor.isQueueClear())
+
+class AdvancedMapTest(unittest.TestCase):
+    def test_lazy_steps_run_once_when_results_are_needed(self):
+        seen = []
+        results = jutils.AdvancedMap(range(6), lazy = True).mapResults(lambda x: seen.append(x) or x * 2).filterResults(lambda x: x % 4 == 0).forEach(seen.append)
+        self.assertEqual(seen, [])
+        self.assertEqual(results.getResults(), [0, 4, 8])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(list(results), [0, 4, 8])
+        self.assertEqual(seen, [0, 0, 1, 2, 4, 3, 4, 8, 5])
+
+    def test_lazy_additions_are_chained(self):
+        data = [1, 2]
+        results = jutils.AdvancedMap(data, lazy = True)
+        results += [3]
+        results += 4
+        results.addMapToResults(lambda x: x * 10, [5])
+        data.append(9)
+        self.assertEqual(results.getResults(), [1, 2, 9, 3, 4, 50])
+        results += results
+        self.assertEqual(results.getResults(), [1, 2, 9, 3, 4, 50] * 2)
+
+    def test_lazy_and_eager_maps_match(self):
+        for lazy in (False, True):
+            results = jutils.AdvancedMap(range(10), 10, lazy = lazy).mapResults(lambda x: x + 1).filterResults(lambda x: x % 2 == 1).selectivelyMapResults(lambda x: x > 5, str)
+            self.assertEqual(results.getResults(), [1, 3, 5, "7", "9", "11"], lazy)
+
+class RoundTripCommand(RecordCommand):
+    """Makes 'count' round trips over 'steps' steps, waiting at 'barrier' after each step so commands on other threads interleave with it."""
+    def __init__(self, instrumentation, name, count, steps = 0, barrier = None):
+        super().__init__()
+        self.instrumentation = instrumentation
+        self.name = name
+        self.count = count
+        self.steps = max(count, steps)
+        self.barrier = barrier
+
+    def getName(self):
+        return self.name
+
+    def execute(self, args):
+        for x in range(0, self.steps):
+            if x < self.count:
+                self.instrumentation.increment("db.roundTrips")
+            if self.barrier != None:
+                self.barrier.wait()
+
+class InstrumentationTest(unittest.TestCase):
+    def setUp(self):
+        self.instrumentation = jutils.Instrumentation()
+
+    def test_round_trips_are_counted_per_thread(self):
+        barrier = threading.Barrier(2)
+        commands = [RoundTripCommand(self.instrumentation, "few", 2, 5, barrier), RoundTripCommand(self.instrumentation, "many", 5, 5, barrier)]
+        threads = [threading.Thread(target = self.instrumentation.executeCommand, args = (x, [])) for x in commands]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.instrumentation.getCounter("db.roundTrips"), 7)
+        self.assertEqual(self.instrumentation.getCounter("command.few.roundTrips"), 2)
+        self.assertEqual(self.instrumentation.getCounter("command.many.roundTrips"), 5)
+
+    def test_nested_and_propagated_round_trips_count_towards_the_command(self):
+        inner = RoundTripCommand(self.instrumentation, "inner", 2)
+        outer = RoundTripCommand(self.instrumentation, "outer", 0)
+        def execute(args):
+            self.instrumentation.increment("db.roundTrips")
+            self.instrumentation.executeCommand(inner, [])
+            worker = threading.Thread(target = self.instrumentation.propagate(lambda: self.instrumentation.increment("db.roundTrips", 3)))
+            worker.start()
+            worker.join()
+        outer.execute = execute
+        self.instrumentation.executeCommand(outer, [])
+        self.assertEqual(self.instrumentation.getCounter("command.inner.roundTrips"), 2)
+        self.assertEqual(self.instrumentation.getCounter("command.outer.roundTrips"), 6)
+
+class TimedCommand(RecordCommand):
+    """Records when each run started. The first run takes 'delay' seconds."""
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def execute(self, args):
+        self.calls.append(time.monotonic())
+        if len(self.calls) == 1:
+            time.sleep(self.delay)
+
+class PromptCommand(RecordCommand):
+    def getName(self):
+        return "prompt"
+
+    def isInteractive(self, args):
+        return True
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        jutils.storedVariables = {}
+        self.processor = jutils.CommandProcessor2({})
+        self.scheduler = self.processor.scheduler
+
+    def tearDown(self):
+        for name in list(self.scheduler.getJobs().keys()):
+            self.scheduler.unschedule(name)
+
+    def waitFor(self, name, key, count):
+        deadline = time.monotonic() + 5
+        while self.scheduler.getJobs()[name][key] < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.scheduler.getJobs()[name]
+
+    def test_slow_runs_skip_missed_runs_without_drifting(self):
+        record = TimedCommand(0.25)
+        self.processor.registerCommands([record])
+        self.scheduler.schedule("timed", 100, "record", ["x"])
+        first = time.monotonic() + 0.1
+        job = self.waitFor("timed", "runs", 4)
+        self.scheduler.unschedule("timed")
+        self.assertEqual(job["errors"], 0)
+        self.assertGreaterEqual(job["skipped"], 1)
+        # The run that was due during the slow one starts late, the ones after it are back on the schedule.
+        for start in [record.calls[0]] + record.calls[2:]:
+            offset = (start - first) % 0.1
+            self.assertLess(min(offset, 0.1 - offset), 0.04)
+
+    def test_failed_runs_are_not_counted_as_runs(self):
+        self.processor.registerCommands([RecordCommand()])
+        self.scheduler.schedule("failing", 20, "record", [])
+        self.processor.commands["record"].execute = lambda args: 1 / 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            job = self.waitFor("failing", "errors", 2)
+        self.assertEqual(job["runs"], 0)
+
+    def test_interactive_commands_cant_be_scheduled(self):
+        self.processor.registerCommands([PromptCommand(), jutils.ExitCommand()])
+        for command in ("prompt", "exit"):
+            with self.assertRaises(ValueError):
+                self.scheduler.schedule(command, 20, command, ["x"])
+        self.assertEqual(self.scheduler.getJobs(), {})
+
+    def test_scheduled_scripts_cant_run_interactive_commands(self):
+        prompt = PromptCommand()
+        self.processor.registerCommands([prompt, jutils.RunScriptCommand(self.processor), jutils.PrintCommand()])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "script.txt")
+            with open(path, "w") as fileWrite:
+                fileWrite.write("prompt x\nprint after\n")
+            self.scheduler.schedule("script", 20, "run", [path])
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                job = self.waitFor("script", "errors", 1)
+                self.scheduler.unschedule("script")
+        self.assertEqual(job["runs"], 0)
+        self.assertEqual(prompt.calls, [])
+        self.assertNotIn("after", output.getvalue())
+        self.assertTrue(self.processor.isQueueClear())
+
+class SubstituteTest(unittest.TestCase):
+    values = {"a": "1", "b": 22, "n": None}
+
+    def test_matches_replace_all(self):
+        words = ["%a%", "%b%", "%missing%", "%n%", "x", "a", "%", "%%", "50%", "%a%%b%"]
+        generator = random.Random(7)
+        for i in range(0, 2000):
+            string = " ".join(generator.choice(words) for x in range(0, generator.randint(0, 8)))
+            self.assertEqual(jutils.Utilities.substitute(string, self.values), jutils.Utilities.replaceAll(string, self.values), string)
+
+    def test_unknown_and_empty_names_are_left_alone(self):
+        self.assertEqual(jutils.Utilities.substitute("%missing% %n% %% %a%", self.values), "%missing% %n% %% 1")
+        self.assertEqual(jutils.Utilities.substitute("no variables", self.values), "no variables")
+
+    def test_names_are_read_left_to_right(self):
+        self.assertEqual(jutils.Utilities.substitute("%b%a%", self.values), "22a%")
+        self.assertEqual(jutils.Utilities.substitute("%missing%a%", self.values), "%missing1")
+
+    def test_templates_are_reused(self):
+        template = jutils.Utilities.compileTemplate("print %a% %b%")
+        self.assertIs(jutils.Utilities.compileTemplate("print %a% %b%"), template)
+        self.assertEqual(template, ((6, 8, 10, 12), ("a", " ", "b")))
+
+class BufferedLoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "test.log")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def readRecords(self):
+        with open(self.filename, "r") as fileRead:
+            return [json.loads(x) for x in fileRead]
+
+    def test_a_nearly_full_buffer_is_written_before_the_interval(self):
+        logger = jutils.BufferedLogger(self.filename, capacity = 8, flushInterval = 60000)
+        for x in range(6):
+            logger.log("info", f"record {x}")
+        deadline = time.monotonic() + 5
+        while logger.getStats()["written"] < 6 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(logger.getStats()["written"], 6)
+        logger.close()
+
+    def test_close_writes_everything_buffered(self):
+        logger = jutils.BufferedLogger(self.filename, flushInterval = 60000)
+        logger.log("info", "first")
+        logger.log("error", "second", user = "user1")
+        logger.close()
+        self.assertEqual([(x["level"], x["message"]) for x in self.readRecords()], [("info", "first"), ("error", "second")])
+        self.assertEqual(logger.getStats()["dropped"], 0)
+
+class ScriptTest(unittest.TestCase):
+    def setUp(self):
+        jutils.storedVariables = {}
+        self.processor = jutils.CommandProcessor2({})
+        self.processor.registerCommands([jutils.DefineCommand(), jutils.DefineIntCommand(), jutils.AddCommand(), jutils.PrintCommand(), jutils.CompareCommand(), jutils.ConditionalCommand(self.processor)])
+
+    def runScript(self, lines):
+        """Runs the script and returns what it printed."""
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.processor.runScript(jutils.ScriptCompiler.compileLines(lines))
+            while self.processor.executeNextInQueue():
+                pass
+        return output.getvalue()
+
+    def test_functions_can_be_called_before_they_are_defined(self):
+        output = self.runScript(["defint total 0", "call twice", "call twice", "print %total%", "function twice", "call once", "call once", "end", "function once", "add total 1", "end"])
+        self.assertEqual(output.split(), ["4"])
+
+    def test_while_loops_until_the_condition_fails(self):
+        output = self.runScript(["defint i 0", "while i < 3", "print %i%", "add i 1", "end", "print done"])
+        self.assertEqual(output.split(), ["0", "1", "2", "done"])
+        self.assertEqual(jutils.storedVariables["script-iterations"], 3)
+
+    def test_foreach_walks_lists_and_comma_separated_strings(self):
+        jutils.storedVariables["names"] = ["a", "b"]
+        output = self.runScript(["define letters \"x, y\"", "foreach n in names", "foreach l in letters", "print %n%%l%", "end", "end"])
+        self.assertEqual(output.split(), ["ax", "ay", "bx", "by"])
+
+    def test_break_only_leaves_the_innermost_loop(self):
+        jutils.storedVariables["outer"] = ["1", "2"]
+        jutils.storedVariables["inner"] = ["a", "b", "c"]
+        output = self.runScript(["foreach o in outer", "foreach i in inner", "conditional i b break", "print %o%%i%", "end", "end"])
+        self.assertEqual(output.split(), ["1a", "2a"])
+
+    def test_return_at_the_top_level_ends_the_script(self):
+        output = self.runScript(["print before", "return", "print after"])
+        self.assertEqual(output.split(), ["before"])
+        self.assertTrue(self.processor.isQueueClear())
+
+    def test_conditional_calls_can_recurse(self):
+        output = self.runScript(["defint n 3", "call countdown", "print done", "function countdown", "print %n%", "add n -1", "compare n > 0", "conditional results true \"call countdown\"", "end"])
+        self.assertEqual(output.split(), ["3", "2", "1", "done"])
+
+    def test_functions_cannot_be_defined_twice(self):
+        with self.assertRaises(jutils.ScriptError):
+            jutils.ScriptCompiler.compileLines(["function a", "end", "function a", "end"])
+
+if __name__ == "__main__":
+    unittest.main()